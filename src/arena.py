@@ -2,22 +2,66 @@ import numpy as np
 import sys
 sys.path.append('pytorch_classification')
 from pytorch_classification.utils import Bar, AverageMeter
+import math
 import time
 
 
+class SequentialTest():
+    """
+    Sequential probability ratio test of the solve rate of a model against an
+    update threshold. It weighs the hypothesis that the solve rate is
+    threshold + margin (accept) against threshold - margin (reject), and
+    settles once the log likelihood ratio leaves the bounds given by the error
+    rate, usually after a handful of games when the model is clearly better
+    or worse.
+    """
+
+    ACCEPT = 'accept'
+    REJECT = 'reject'
+
+    def __init__(self, threshold, margin=0.1, error=0.05):
+        self.p_reject = min(max(threshold - margin, 1e-3), 1 - 1e-3)
+        self.p_accept = min(max(threshold + margin, 1e-3), 1 - 1e-3)
+        self.upper = math.log((1 - error) / error)
+        self.lower = -self.upper
+        self.llr = 0.
+
+    def update(self, solved):
+        """
+        Adds the result of one game.
+        """
+        if solved:
+            self.llr += math.log(self.p_accept / self.p_reject)
+        else:
+            self.llr += math.log((1 - self.p_accept) / (1 - self.p_reject))
+
+    def decision(self):
+        """
+        Returns ACCEPT or REJECT once the test is settled, None before.
+        """
+        if self.llr >= self.upper:
+            return self.ACCEPT
+        if self.llr <= self.lower:
+            return self.REJECT
+        return None
+
+
 class Arena():
-    def __init__(self, player, game, display=None, time_out=10000):
+    def __init__(self, player, game, display=None, time_out=10000, start_puzzle=None):
         """
         Input:
             player 1: one function that takes board as input, return action
             game: Game object
             display: a function that takes board as input and prints it. 
                     Is necessary for verbose mode.
+            start_puzzle: an optional function called before every game, e.g.
+                    MCTS.start_puzzle to start its per puzzle time budget.
         """
         self.player = player
         self.game = game
         self.display = display
         self.time_out = time_out
+        self.start_puzzle = start_puzzle
 
     def playGame(self, verbose=False):
         """
@@ -29,6 +73,8 @@ class Arena():
                 0 if not
         """
         board = self.game.get_initial_board()
+        if self.start_puzzle is not None:
+            self.start_puzzle()
         it = 0
         while self.game.has_puzzle_ended(board) == 0 and it < self.time_out:
             it += 1
@@ -38,8 +84,7 @@ class Arena():
                 self.display(board)
             action = self.player(board)
 
-            valids = self.game.get_valid_moves(
-                board, 1)
+            valids = self.game.get_valid_moves(board)
 
             if valids[action] == 0:
                 print(action)
@@ -52,25 +97,28 @@ class Arena():
             self.display(board)
         return self.game.has_puzzle_ended(board)
 
-    def playGames(self, num, verbose=False):
+    def playGames(self, num, verbose=False, gate=None, results=None):
         """
-        Plays num games.
+        Plays num games, or consumes num game results from an iterator such as
+        a pool of arena workers. With a SequentialTest gate, stops as soon as
+        the gate is settled.
         Returns:
             solved: number of solved puzzles
             timed_out: number of timed_out puzzles
         """
+        if results is None:
+            results = (self.playGame(verbose=verbose) for _ in range(int(num)))
+
         eps_time = AverageMeter()
         bar = Bar('Arena.playGames', max = num)
         end = time.time()
         eps = 0
         maxeps = int(num)
 
-        num = int(num / 2)
         solved = 0
         timed_out = 0
 
-        for _ in range(num):
-            gameResult = self.playGame(verbose=verbose)
+        for gameResult in results:
             if gameResult == 1:
                 solved += 1
             else:
@@ -79,10 +127,17 @@ class Arena():
             eps += 1
             eps_time.update(time.time() - end)
             end = time.time()
-            bar.suffix = '({eps}/{maxeps}) Eps Time: {et:.3f}s | Total: {total:} | ETA: {eta:}'.format(eps=eps+1, maxeps=maxeps, et=eps_time.avg,
+            bar.suffix = '({eps}/{maxeps}) Eps Time: {et:.3f}s | Total: {total:} | ETA: {eta:}'.format(eps=eps, maxeps=maxeps, et=eps_time.avg,
                                                                                                        total=bar.elapsed_td, eta=bar.eta_td)
             bar.next()
 
+            if gate is not None:
+                gate.update(gameResult == 1)
+                if gate.decision() is not None:
+                    break
+            if eps >= maxeps:
+                break
+
         bar.finish()
 
         return solved, timed_out
@@ -0,0 +1,116 @@
+import queue
+import threading
+import numpy as np
+from compactExamples import examples_to_columns
+from replayStore import Shard
+
+
+class BatchPipeline():
+    """
+    Training examples kept in contiguous column arrays and served as dense
+    float32 (boards, pis, vs) batches. Every epoch visits the examples once,
+    in a new random order and without replacement, with a random symmetry of
+    the game applied to each example. A background thread assembles the next
+    batches while the current one trains, gathering the rows of every batch
+    straight from the memory-mapped shard columns of a replay view.
+    """
+
+    def __init__(self, examples, game, batch_size, prefetch=2):
+        """
+        examples: a list of compact Examples or a replayStore.ReplayView
+        """
+        self.sources = self._sources(examples)
+        self.ends = np.cumsum([len(columns['vs']) for columns in self.sources], dtype=np.int64)
+        self.size = int(self.ends[-1]) if len(self.ends) else 0
+
+        self.game = game
+        self.action_size = game.get_action_size()
+        self.symmetries = game.get_symmetry_ids()
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+
+    @staticmethod
+    def _sources(examples):
+        """
+        Returns the column dicts of the examples: those of every shard of a
+        replay view, left memory-mapped, or else one dict packed in memory.
+        """
+        shards = getattr(examples, 'shards', None)
+        if shards is None:
+            return [examples_to_columns(examples)] if len(examples) else []
+        return [{column: getattr(shard, column) for column in Shard.COLUMNS}
+                for shard in shards if len(shard)]
+
+    def __len__(self):
+        """
+        Number of full batches in an epoch.
+        """
+        return self.size // self.batch_size
+
+    def batch(self, ids, symmetry_ids):
+        """
+        Assembles the dense batch of the examples ids, each transformed by the
+        symmetry of the same position in symmetry_ids. The rows of every
+        source are read in increasing order to keep the reads of a shard local.
+        """
+        board_shape = self.sources[0]['boards'].shape[1:]
+        boards = np.empty((len(ids),) + board_shape, dtype=np.float32)
+        pis = np.zeros((len(ids), self.action_size), dtype=np.float32)
+        vs = np.empty(len(ids), dtype=np.float32)
+
+        sources = np.searchsorted(self.ends, ids, side='right')
+        for k in np.unique(sources):
+            columns = self.sources[k]
+            rows = np.flatnonzero(sources == k)
+            local = ids[rows] - (self.ends[k - 1] if k > 0 else 0)
+            order = np.argsort(local)
+            rows, local = rows[order], local[order]
+
+            boards[rows] = columns['boards'][local]
+            vs[rows] = columns['vs'][local]
+
+            # scatter the sparse policies of the rows into the dense matrix
+            pi_offsets = columns['pi_offsets']
+            starts = np.asarray(pi_offsets[local])
+            lengths = np.asarray(pi_offsets[local + 1]) - starts
+            entries = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + \
+                np.repeat(starts, lengths)
+            pis[np.repeat(rows, lengths), columns['pi_index'][entries]] = columns['pi_prob'][entries]
+
+        for k, symmetry in enumerate(self.symmetries):
+            selected = np.flatnonzero(symmetry_ids == k)
+            if len(selected):
+                boards[selected], pis[selected] = self.game.apply_symmetry_batch(
+                    boards[selected], pis[selected], symmetry)
+
+        return boards, pis, vs
+
+    def epoch(self):
+        """
+        Yields the batches of one epoch, assembled ahead by a background thread.
+        """
+        order = np.random.permutation(self.size)
+        symmetry_ids = np.random.randint(len(self.symmetries), size=self.size)
+        batches = queue.Queue(maxsize=self.prefetch)
+
+        def produce():
+            try:
+                for b in range(len(self)):
+                    ids = order[b * self.batch_size:(b + 1) * self.batch_size]
+                    batches.put(self.batch(ids, symmetry_ids[ids]))
+                batches.put(None)
+            except Exception as e:
+                batches.put(e)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+
+        thread.join()
@@ -0,0 +1,8 @@
+"""
+Benchmarks of the board, search, inference and training hot paths.
+
+Run from src:
+    python -m benchmarks run -o results.json [-g board search ...] [--quick] [-- main.py args]
+    python -m benchmarks compare baseline.json results.json [--threshold 0.1]
+"""
+from benchmarks.core import BENCHMARKS, benchmark, measure, run, compare, load_results, save_results
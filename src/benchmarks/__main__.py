@@ -0,0 +1,48 @@
+import argparse
+import sys
+from benchmarks.core import run, compare, load_results, save_results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Sokoban benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="Run benchmarks and write their results as JSON. "
+                                                 "Arguments after -- are passed to the main.py parser.")
+    run_parser.add_argument('-o', '--output', default='benchmarks.json', help="Results file")
+    run_parser.add_argument('-g', '--groups', nargs='*', default=None,
+                            help="Groups to run: board, search, inference, training, solver")
+    run_parser.add_argument('--quick', action='store_true', default=False, help="Fewer and shorter repeats")
+
+    compare_parser = commands.add_parser('compare', help="Compare two results files, failing on regressions")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                                help="Relative slowdown counted as a regression")
+
+    if '--' in argv:
+        split = argv.index('--')
+        argv, main_argv = argv[:split], argv[split + 1:]
+    else:
+        main_argv = []
+    options = parser.parse_args(argv)
+
+    if options.command == 'run':
+        from main import get_parser
+        args = get_parser().parse_args(main_argv)
+        document = run(args, options.groups, options.quick)
+        save_results(document, options.output)
+        print("Results written to", options.output)
+        return 0
+
+    rows = compare(load_results(options.baseline), load_results(options.current), options.threshold)
+    for name, base, current, change, regressed in rows:
+        print('{:<48} {:>14.4f} {:>14.4f} {:>+8.1%}{}'.format(
+            name, base, current, change, '  REGRESSION' if regressed else ''))
+    regressions = sum(row[4] for row in rows)
+    print(regressions, "regressions beyond {:.0%}".format(options.threshold))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,124 @@
+import json
+import os
+import platform
+import subprocess
+import time
+import numpy as np
+
+
+# group -> list of benchmark functions, filled by the benchmark decorator
+BENCHMARKS = {}
+
+
+def benchmark(group):
+    """
+    Registers a benchmark function in a group. The function is called with
+    the main.py arguments and the quick flag, and returns a list of result
+    dicts built by result().
+    """
+    def register(fn):
+        BENCHMARKS.setdefault(group, []).append(fn)
+        return fn
+    return register
+
+
+def result(name, samples, unit, higher_is_better):
+    """
+    Summarizes the samples of one metric by their median.
+    """
+    return {'name': name, 'value': float(np.median(samples)), 'unit': unit,
+            'higher_is_better': higher_is_better, 'samples': [float(x) for x in samples]}
+
+
+def measure(fn, repeat=5, min_time=0.2):
+    """
+    Times fn like timeit.autorange: the number of calls per repeat is doubled
+    until a repeat lasts min_time. Returns the seconds per call of every repeat.
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    samples = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+    return samples
+
+
+def _metadata(args):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    import torch
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'args': vars(args),
+    }
+
+
+def run(args, groups=None, quick=False):
+    """
+    Runs the benchmarks of the given groups, every group by default.
+    Returns the results document: run metadata and the results by name.
+    """
+    # the suites register themselves on import
+    import benchmarks.suites
+
+    results = {}
+    for group in groups or sorted(BENCHMARKS):
+        if group not in BENCHMARKS:
+            raise ValueError("Unknown benchmark group {}".format(group))
+        for fn in BENCHMARKS[group]:
+            for entry in fn(args, quick):
+                name = '{}.{}'.format(group, entry.pop('name'))
+                results[name] = entry
+                print('{:<48} {:>14.4f} {}'.format(name, entry['value'], entry['unit']))
+
+    return {'meta': _metadata(args), 'results': results}
+
+
+def save_results(document, path):
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=1, default=str)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Compares two results documents. A benchmark regresses when it got worse
+    by more than threshold, relative to the baseline.
+    Returns a list of (name, baseline value, current value, relative change,
+    regressed) rows, the change being positive when the benchmark improved.
+    """
+    rows = []
+    for name, base in sorted(baseline['results'].items()):
+        entry = current['results'].get(name)
+        if entry is None:
+            continue
+        change = (entry['value'] - base['value']) / base['value'] if base['value'] else 0.
+        if not base['higher_is_better']:
+            change = -change
+        rows.append((name, base['value'], entry['value'], change, change < -threshold))
+    return rows
@@ -0,0 +1,169 @@
+import copy
+import glob
+import os
+import re
+import time
+import numpy as np
+from benchmarks.core import benchmark, measure, result
+
+
+def _puzzles():
+    """
+    Paths of the data/puzzleN.txt files, in puzzle order.
+    """
+    paths = glob.glob(os.path.join('..', 'data', 'puzzle*.txt'))
+    return sorted(paths, key=lambda path: int(re.findall(r'\d+', os.path.basename(path))[0]))
+
+
+def _game(args, path=None):
+    from main import make_game
+    if path is not None:
+        args = copy.copy(args)
+        args.puzzle = path
+    return make_game(args)
+
+
+class UniformNet():
+    """
+    Evaluator returning uniform priors and a zero value, so that the search
+    benchmarks measure the tree alone; the network is measured by the
+    inference benchmarks.
+    """
+
+    def __init__(self, game):
+        self.action_size = game.get_action_size()
+
+    def predict(self, board):
+        return np.full(self.action_size, 1. / self.action_size), np.zeros(1)
+
+    def predict_batch(self, boards):
+        return np.full((len(boards), self.action_size), 1. / self.action_size), np.zeros(len(boards))
+
+
+@benchmark('board')
+def board_operations(args, quick):
+    """
+    Microbenchmarks of the Board operations on the selected puzzle.
+    """
+    game = _game(args)
+    board = game.get_initial_board()
+    repeat = 3 if quick else 7
+
+    move = sorted(board.get_moves())[0]
+    back = (-move[0], -move[1])
+
+    def execute_moves():
+        board.execute_move(move)
+        board.execute_move(back)
+
+    results = []
+    for name, fn, calls in (('get_moves', board.get_moves, 1),
+                            ('execute_move', execute_moves, 2),
+                            ('end_test', board.end_test, 1),
+                            ('string_representation', lambda: game.string_representation(board), 1)):
+        samples = measure(fn, repeat)
+        results.append(result(name, [1e6 * s / calls for s in samples], 'us/op', False))
+    return results
+
+
+@benchmark('search')
+def search_speed(args, quick):
+    """
+    MCTS simulations per second from the initial board of every puzzle, with
+    a fresh tree per repeat.
+    """
+    from mcts import MCTS
+
+    simulations = 50 if quick else args.numMCTSSims * 8
+    results = []
+    for path in _puzzles():
+        game = _game(args, path)
+        net = UniformNet(game)
+        samples = []
+        for _ in range(3 if quick else 5):
+            mcts = MCTS(game, net, args)
+            board = game.get_initial_board()
+            start = time.perf_counter()
+            sims = 0
+            while sims < simulations:
+                sims += mcts.simulate(board)
+            samples.append(sims / (time.perf_counter() - start))
+        name = os.path.splitext(os.path.basename(path))[0]
+        results.append(result('sims_per_second.' + name, samples, 'sims/s', True))
+    return results
+
+
+@benchmark('inference')
+def predict_latency(args, quick):
+    """
+    NNetWrapper.predict latency at batch 1 and predict_batch latency at
+    batches 16 and 64, without the evaluation cache.
+    """
+    from nnwrapper import NNetWrapper
+
+    args = copy.copy(args)
+    args.evalCacheSize = 0
+    game = _game(args)
+    nnet = NNetWrapper(game, args)
+    board = game.get_initial_board()
+    repeat = 3 if quick else 7
+
+    results = [result('predict_latency.batch1', [1e3 * s for s in measure(lambda: nnet.predict(board), repeat)],
+                      'ms', False)]
+    for size in (16, 64):
+        boards = [board] * size
+        samples = measure(lambda: nnet.predict_batch(boards), repeat)
+        results.append(result('predict_latency.batch{}'.format(size), [1e3 * s for s in samples], 'ms', False))
+    return results
+
+
+@benchmark('training')
+def training_speed(args, quick):
+    """
+    NNetWrapper.train samples per second over one epoch of random examples.
+    """
+    from compactExamples import compress_example
+    from nnwrapper import NNetWrapper
+
+    args = copy.copy(args)
+    args.epochs = 1
+    game = _game(args)
+    nnet = NNetWrapper(game, args)
+    board = game.get_initial_board().board
+    rng = np.random.default_rng(0)
+
+    examples = []
+    for _ in range(args.batch_size * (4 if quick else 16)):
+        pi = rng.random(game.get_action_size())
+        examples.append(compress_example(board, pi / pi.sum(), rng.choice([-1, 1])))
+
+    samples = []
+    for _ in range(2 if quick else 3):
+        start = time.perf_counter()
+        nnet.train(examples)
+        samples.append(len(examples) / (time.perf_counter() - start))
+    return [result('samples_per_second', samples, 'samples/s', True)]
+
+
+@benchmark('solver')
+def solver_speed(args, quick):
+    """
+    Expanded states per second of the A* push solver on every puzzle, within
+    a node limit, and the pushes of the puzzles it solves.
+    """
+    from solver import PushSolver
+
+    max_nodes = 2000 if quick else 20000
+    results = []
+    for path in _puzzles():
+        with open(path) as f:
+            solver = PushSolver(f.read(), max_nodes)
+        name = os.path.splitext(os.path.basename(path))[0]
+        samples = []
+        for _ in range(1 if quick else 3):
+            report = solver.solve('astar')
+            samples.append(report.nodes / max(report.seconds, 1e-9))
+        results.append(result('nodes_per_second.' + name, samples, 'nodes/s', True))
+        if report.status == 'solved':
+            results.append(result('pushes.' + name, [len(report.solution)], 'pushes', False))
+    return results
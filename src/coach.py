@@ -5,11 +5,71 @@ import sys
 sys.path.append('pytorch_classification')
 from pytorch_classification.utils import Bar, AverageMeter
 import time
-from random import shuffle
 import os
-from arena import Arena
-from pickle import Pickler, Unpickler
+from arena import Arena, SequentialTest
+from compactExamples import compress_example
+from replayStore import ReplayStore
+from solver import PushSolver, expert_examples
+from instrumentation import Metrics, MetricsExporter, profile_call
 import sys
+import multiprocessing
+import random
+from contextlib import contextmanager
+import torch
+
+
+# Coach of a self-play or arena worker process, built once per iteration by _initSelfPlayWorker
+_worker_coach = None
+
+
+def _seedEpisode(seed):
+    """
+    Seeds the random generators used during an episode.
+    """
+    if seed is not None:
+        np.random.seed(seed)
+        random.seed(seed)
+        torch.manual_seed(seed)
+
+
+def _initSelfPlayWorker(game, nnet_class, args, checkpoint):
+    """
+    Loads the current weights once in a self-play worker process.
+    """
+    global _worker_coach
+    torch.set_num_threads(1)
+    nnet = nnet_class(game, args)
+    nnet.load_checkpoint(checkpoint)
+    _worker_coach = Coach(game, nnet, args)
+
+
+def _selfPlayEpisode(task):
+    """
+    Runs one episode in a self-play worker for a (seed, profile) task.
+    Returns the episode's training examples, its duration and the snapshot
+    of its metrics, None when instrumentation is disabled.
+    """
+    metrics = _worker_coach.metrics
+    if metrics is not None:
+        metrics.reset()
+    examples, duration = _worker_coach.runEpisode(*task)
+    return examples, duration, metrics.snapshot() if metrics is not None else None
+
+
+def _arenaGame(seed):
+    """
+    Plays one arena game in a worker, reusing the worker's search tree as the
+    sequential arena does. Returns the game result and the snapshot of the
+    metrics of its search, None when instrumentation is disabled.
+    """
+    _seedEpisode(seed)
+    metrics = _worker_coach.metrics
+    if metrics is not None:
+        metrics.reset()
+    mcts = _worker_coach.mcts
+    arena = Arena(lambda x: np.argmax(mcts.getActionProb(x, temp=0)), _worker_coach.game,
+                  start_puzzle=mcts.start_puzzle)
+    return arena.playGame(), metrics.snapshot() if metrics is not None else None
 
 
 class Coach():
@@ -17,21 +77,31 @@ class Coach():
         self.game = game
         self.nnet = nnet
         self.args = args
-        self.mcts = MCTS(self.game, self.nnet, self.args)
-        self.train_history = []
+        self.replay = ReplayStore(os.path.join(self.args.checkpoint, 'replay'),
+                                  self.args.numItersForTrainExamplesHistory)
         self.skip_first = False
 
+        # per iteration instrumentation, None when no metricsFile is given
+        self.metrics = None
+        self.exporter = None
+        if self.args.metricsFile:
+            self.metrics = Metrics()
+            self.exporter = MetricsExporter(self.args.metricsFile, self.args.metricsFormat)
+        self.nnet.metrics = self.metrics
+        self.mcts = MCTS(self.game, self.nnet, self.args, self.metrics)
+
     def executeEpisode(self):
         """
         This function executes one episode of self-play.
-        As the puzzle is explored, each turn is added as a training example to
-        trainExamples. The game is played till the puzzle ends or the limit is reached. 
+        As the puzzle is explored, each turn is added once as a training example to
+        trainExamples; symmetries are applied later, when the training batches are
+        assembled. The game is played till the puzzle ends or the limit is reached. 
         After the puzzle ends, the outcome of the game is used to assign values to 
         each example in trainExamples.
         It uses a temp=1 if episodeStep < tempThreshold, and thereafter
         uses temp=0.
         Returns:
-            trainExamples: a list of examples of the form (canonicalBoard,pi,v)
+            trainExamples: a list of compact Examples of (canonicalBoard,pi,v)
                             pi is the MCTS informed policy vector.
         """
         trainExamples = []
@@ -44,9 +114,7 @@ class Coach():
             temp = int(episodeStep < self.args.tempThreshold)
 
             pi = self.mcts.getActionProb(canonicalBoard, temp=temp)
-            sym = self.game.get_symmetries(canonicalBoard, pi)
-            for b, p in sym:
-                trainExamples.append([b, p, None])
+            trainExamples.append([canonicalBoard.board, pi, None])
 
             action = np.random.choice(len(pi), p=pi)
             board = self.game.get_next_state(board, action)
@@ -54,13 +122,79 @@ class Coach():
             r = self.game.has_puzzle_ended(board)
 
             if r != 0:
-                return [(x[0], x[1], r) for x in trainExamples]
+                if self.metrics is not None:
+                    self.recordEpisode(episodeStep, r)
+                return [compress_example(x[0], x[1], r) for x in trainExamples]
+
+    def recordEpisode(self, steps, result):
+        """
+        Adds the length, result and search tree statistics of an episode to the metrics.
+        """
+        metrics = self.metrics
+        metrics.count('episode.count')
+        metrics.count('episode.steps', steps)
+        metrics.count('episode.solved', int(result == 1))
+        stats = self.mcts.nodes.stats()
+        metrics.count('mcts.nodes', stats['nodes'])
+        metrics.count('mcts.node_store.hits', stats['hits'])
+        metrics.count('mcts.node_store.misses', stats['misses'])
+        metrics.count('mcts.node_store.evictions', stats['evictions'])
+
+    def runEpisode(self, seed, profile=None):
+        """
+        Runs one seeded self-play episode with a fresh search tree. With a
+        profile path prefix the episode is run under cProfile, and with
+        profileMemory under tracemalloc.
+        Returns the episode's training examples and its duration.
+        """
+        start = time.time()
+        _seedEpisode(seed)
+        # reset search tree
+        self.mcts = MCTS(self.game, self.nnet, self.args, self.metrics)
+
+        cache = self.nnet.cache
+        if self.metrics is not None and cache is not None:
+            hits, misses = cache.hits, cache.misses
+
+        if profile is None:
+            examples = self.executeEpisode()
+        else:
+            examples = profile_call(self.executeEpisode, profile, self.args.profileMemory)
+
+        duration = time.time() - start
+        if self.metrics is not None:
+            self.metrics.add_time('selfplay.episode', duration)
+            if cache is not None:
+                self.metrics.count('eval_cache.hits', cache.hits - hits)
+                self.metrics.count('eval_cache.misses', cache.misses - misses)
+        return examples, duration
+
+    def bootstrap(self):
+        """
+        Solves the puzzle with the classical PushSolver and trains the network
+        on the expert examples of its solution before any self-play. Returns
+        the SolverReport; the network is left untouched when no solution is
+        found within the solver limits.
+        """
+        solver = PushSolver(self.game.fcontent, self.args.solverNodes, self.args.solverSeconds,
+                            self.args.solverWeight)
+        report = solver.solve(self.args.solverAlgorithm)
+        print('Solver', report.algorithm, report.status, 'after', report.nodes,
+              'nodes in {:.1f}s'.format(report.seconds))
+        if report.solution is None:
+            return report
+
+        examples = expert_examples(self.game, report.solution)
+        print('Training on', len(examples), 'expert examples of a', len(report.solution), 'push solution')
+        self.nnet.train(examples)
+        return report
 
     def learn(self):
         """
         Performs numIters iterations with numEps episodes of self-play in each
-        iteration. After every iteration, it retrains neural network with
-        examples in trainExamples (which has a maximium length of maxlenofQueue).
+        iteration. After every iteration, the examples of the iteration (which
+        has a maximium length of maxlenofQueue) are appended to the replay store
+        and it retrains neural network with the examples of the stored iterations.
         It then pits the new neural network against the old one and accepts it
         only if it solves >= updateThreshold fraction of puzzles.
         """
@@ -68,6 +202,8 @@ class Coach():
         for i in range(1, self.args.numIters + 1):
             # bookkeeping
             print('------ITER ' + str(i) + '------')
+            if self.metrics is not None:
+                self.metrics.reset()
             # examples of the iteration
             if not self.skip_first or i > 1:
                 iterationTrainExamples = deque(
@@ -75,53 +211,63 @@ class Coach():
 
                 eps_time = AverageMeter()
                 bar = Bar('Self Play', max=self.args.numEps)
-                end = time.time()
 
-                for eps in range(self.args.numEps):
-                    # reset search tree
-                    self.mcts = MCTS(self.game, self.nnet, self.args)
-                    iterationTrainExamples += self.executeEpisode()
+                for eps, (examples, duration) in enumerate(self.selfPlayEpisodes(i)):
+                    iterationTrainExamples += examples
 
                     # bookkeeping + plot progress
-                    eps_time.update(time.time() - end)
-                    end = time.time()
+                    eps_time.update(duration)
                     bar.suffix = '({eps}/{maxeps}) Eps Time: {et:.3f}s | Total: {total:} | ETA: {eta:}'.format(eps=eps+1, maxeps=self.args.numEps, et=eps_time.avg,
                                                                                                                total=bar.elapsed_td, eta=bar.eta_td)
                     bar.next()
                 bar.finish()
 
-                # save the iteration examples to the history
-                self.train_history.append(iterationTrainExamples)
-
-            if len(self.train_history) > self.args.numItersForTrainExamplesHistory:
-                print("len(trainExamplesHistory) =", len(
-                    self.train_history), " => remove the oldest trainExamples")
-                self.train_history.pop(0)
-            # backup history to a file
-            # NB! the examples were collected using the model from the previous iteration, so (i-1)
-            self.saveTrainExamples(i - 1)
+                # append the iteration examples to the history on disk
+                # NB! the examples were collected using the model from the previous iteration, so (i-1)
+                self.saveTrainExamples(i - 1, iterationTrainExamples)
 
-            # shuffle examlpes before training
-            trainExamples = []
-            for e in self.train_history:
-                trainExamples.extend(e)
-            shuffle(trainExamples)
+            # memory-mapped examples of the kept iterations, sampled randomly by train
+            trainExamples = self.replay.examples()
 
             # training new network, keeping a copy of the old one
             self.nnet.save_checkpoint(
                 folder=self.args.checkpoint, filename='temp.pth.tar')
 
+            if self.metrics is not None:
+                start = time.perf_counter()
             self.nnet.train(trainExamples)
-            nmcts = MCTS(self.game, self.nnet, self.args)
+            if self.metrics is not None:
+                self.metrics.add_time('train', time.perf_counter() - start)
+                start = time.perf_counter()
+            # the arena searches are recorded apart, under the arena. prefix
+            arenaMetrics = Metrics() if self.metrics is not None else None
+            nmcts = MCTS(self.game, self.nnet, self.args, arenaMetrics)
 
             print('PITTING AGAINST PREVIOUS VERSION')
-            arena = Arena(lambda x: np.argmax(nmcts.getActionProb(x, temp=0)), self.game)
-            wins, timeouts = arena.playGames(self.args.arenaCompare)
+            gate = None
+            if self.args.arenaMargin > 0:
+                gate = SequentialTest(self.args.updateThreshold, self.args.arenaMargin, self.args.arenaError)
+            arena = Arena(lambda x: np.argmax(nmcts.getActionProb(x, temp=0)), self.game,
+                          start_puzzle=nmcts.start_puzzle)
+            with self.arenaGames(i, arenaMetrics) as results:
+                wins, timeouts = arena.playGames(self.args.arenaCompare, gate=gate, results=results)
+
+            if self.metrics is not None:
+                self.metrics.merge(arenaMetrics.snapshot(), 'arena.')
+                self.metrics.add_time('arena', time.perf_counter() - start)
+                self.metrics.count('arena.games', wins + timeouts)
+                self.metrics.count('arena.solved', wins)
 
-            if wins + timeouts > 0 and float(wins)/(wins + timeouts) < self.args.updateThreshold:
+            decision = gate.decision() if gate is not None else None
+            if decision is not None:
+                print('Arena settled after', wins + timeouts, 'games')
+                rejected = decision == SequentialTest.REJECT
+            else:
+                rejected = wins + timeouts > 0 and float(wins)/(wins + timeouts) < self.args.updateThreshold
+
+            if rejected:
                 print('REJECTING NEW MODEL')
-                self.nnet.load_checkpoint(
-                    folder=self.args.checkpoint, filename='temp.pth.tar')
+                self.nnet.load_checkpoint(os.path.join(self.args.checkpoint, 'temp.pth.tar'))
             else:
                 print('ACCEPTING NEW MODEL')
                 self.nnet.save_checkpoint(
@@ -129,31 +275,105 @@ class Coach():
                 self.nnet.save_checkpoint(
                     folder=self.args.checkpoint, filename='best.pth.tar')
 
+            if self.exporter is not None:
+                self.exporter.write(i, self.metrics)
+
+    def selfPlayEpisodes(self, iteration):
+        """
+        Yields the (trainExamples, episode time) of the numEps self-play episodes
+        of an iteration, in episode order.
+        With numSelfPlayWorkers > 1 the episodes are run by a pool of worker
+        processes that load the current weights once and each run
+        executeEpisode with their own MCTS. When a seed is given every episode
+        is seeded from (seed, iteration, episode), so a run is reproducible
+        whatever the number of workers.
+        """
+        seeds = self.episodeSeeds(iteration, self.args.numEps)
+        profiles = [None] * self.args.numEps
+        if iteration == self.args.profileIteration and 0 <= self.args.profileEpisode < self.args.numEps:
+            if not os.path.exists(self.args.checkpoint):
+                os.makedirs(self.args.checkpoint)
+            profiles[self.args.profileEpisode] = os.path.join(
+                self.args.checkpoint, 'profile_iter{}_ep{}'.format(iteration, self.args.profileEpisode))
+
+        if self.args.numSelfPlayWorkers <= 1:
+            for seed, profile in zip(seeds, profiles):
+                yield self.runEpisode(seed, profile)
+            return
+
+        self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='selfplay.pth.tar')
+        checkpoint = os.path.join(self.args.checkpoint, 'selfplay.pth.tar')
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(self.args.numSelfPlayWorkers, initializer=_initSelfPlayWorker,
+                          initargs=(self.game, type(self.nnet), self.args, checkpoint)) as pool:
+            for examples, duration, snapshot in pool.imap(_selfPlayEpisode, zip(seeds, profiles)):
+                if snapshot is not None:
+                    self.metrics.merge(snapshot)
+                yield examples, duration
+
+    def episodeSeeds(self, iteration, count, *stream):
+        """
+        Returns the seeds of count episodes of an iteration, drawn from
+        (seed, iteration, *stream, episode), or None for each when no seed is given.
+        """
+        if self.args.seed is None:
+            return [None] * count
+        return [int(np.random.SeedSequence([self.args.seed, iteration] + list(stream) + [eps]).generate_state(1)[0])
+                for eps in range(count)]
+
+    @contextmanager
+    def arenaGames(self, iteration, metrics=None):
+        """
+        Yields None for the sequential arena, or with numArenaWorkers > 1 an
+        iterator of the results of arenaCompare games played by a pool of
+        worker processes with the current weights, the metrics of every game
+        being merged into metrics when given. Results come in submission
+        order, not completion order: solved games end sooner than timeouts,
+        and a gate fed the first finished games would be biased towards
+        accepting. Leaving the context terminates the pool, so unfinished
+        games are cancelled once the gate is settled.
+        """
+        if self.args.numArenaWorkers <= 1:
+            yield None
+            return
+
+        self.nnet.save_checkpoint(folder=self.args.checkpoint, filename='arena.pth.tar')
+        checkpoint = os.path.join(self.args.checkpoint, 'arena.pth.tar')
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(self.args.numArenaWorkers, initializer=_initSelfPlayWorker,
+                          initargs=(self.game, type(self.nnet), self.args, checkpoint)) as pool:
+            seeds = self.episodeSeeds(iteration, self.args.arenaCompare, 1)
+
+            def results():
+                for result, snapshot in pool.imap(_arenaGame, seeds):
+                    if metrics is not None and snapshot is not None:
+                        metrics.merge(snapshot)
+                    yield result
+
+            yield results()
+
     def getCheckpointFile(self, iteration):
         return 'checkpoint_' + str(iteration) + '.pth.tar'
 
-    def saveTrainExamples(self, iteration):
-        folder = self.args.checkpoint
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        filename = os.path.join(
-            folder, self.getCheckpointFile(iteration) + ".examples")
-        with open(filename, "wb+") as f:
-            Pickler(f).dump(self.train_history)
-        f.closed
+    def saveTrainExamples(self, iteration, examples):
+        """
+        Appends the examples of an iteration to the replay store as a new shard.
+        """
+        self.replay.append(iteration, examples)
 
     def loadTrainExamples(self):
-        modelFile = self.args.load_folder_file
-        examplesFile = modelFile + ".examples"
-        if not os.path.isfile(examplesFile):
-            print(examplesFile)
-            r = input("File with trainExamples not found. Continue? [y|n]")
+        """
+        Opens the replay store saved next to the loaded model.
+        """
+        replayFolder = os.path.join(os.path.dirname(self.args.load_folder_file), 'replay')
+        replay = ReplayStore(replayFolder, self.args.numItersForTrainExamplesHistory, resume=True)
+        if len(replay) == 0:
+            print(replayFolder)
+            r = input("Replay store with trainExamples not found. Continue? [y|n]")
             if r != "y":
                 sys.exit()
         else:
-            print("File with trainExamples found. Read it.")
-            with open(examplesFile, "rb") as f:
-                self.train_history = Unpickler(f).load()
-            f.closed
+            print("Replay store with trainExamples found. Use it.")
+            self.replay = replay
             # examples based on the model were already collected (loaded)
             self.skip_first = True
@@ -0,0 +1,37 @@
+from collections import namedtuple
+import numpy as np
+
+
+# A training example stored compactly: the uint8 board of character codes, the
+# nonzero entries of the policy as parallel (index, probability) arrays and
+# the float32 value.
+Example = namedtuple('Example', ['board', 'pi_index', 'pi_prob', 'v'])
+
+
+def compress_example(board, pi, v):
+    """
+    Builds the compact Example of a (board, pi, v) training example.
+    """
+    pi = np.asarray(pi, dtype=np.float32)
+    pi_index = np.flatnonzero(pi).astype(np.int32)
+    return Example(np.asarray(board, dtype=np.uint8), pi_index, pi[pi_index], np.float32(v))
+
+
+def examples_to_columns(examples):
+    """
+    Packs Examples into contiguous column arrays:
+        boards: (n, width, height) uint8
+        pi_offsets: (n + 1,) int64, example i owns pi_index/pi_prob[pi_offsets[i]:pi_offsets[i + 1]]
+        pi_index: int32 and pi_prob: float32, the sparse policies
+        vs: (n,) float32
+    """
+    lengths = [len(example.pi_index) for example in examples]
+    pi_offsets = np.zeros(len(examples) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=pi_offsets[1:])
+    return {
+        'boards': np.stack([example.board for example in examples]).astype(np.uint8),
+        'pi_offsets': pi_offsets,
+        'pi_index': np.concatenate([example.pi_index for example in examples]).astype(np.int32),
+        'pi_prob': np.concatenate([example.pi_prob for example in examples]).astype(np.float32),
+        'vs': np.array([example.v for example in examples], dtype=np.float32),
+    }
@@ -0,0 +1,249 @@
+import math
+import numpy as np
+from evalcache import EvaluationCache
+
+
+class Matching():
+    """
+    Minimum cost assignment of the boxes of one box set to goals, reduced to
+    what a cache entry needs: the bound, and for a square assignment the
+    column potentials and the assignment of the Hungarian algorithm, enough
+    to repair it after a push instead of solving it again. The cost rows are
+    gathered again from the push distances, and the row potentials follow
+    from the assigned edges, which are tight.
+    Rows are boxes, columns are goals, both 1-indexed with 0 as the dummy
+    index of the algorithm.
+    """
+
+    __slots__ = ('boxes', 'bound', 'v', 'p')
+
+    def __init__(self, boxes, bound, v=None, p=None):
+        self.boxes = boxes      # box square of every row
+        self.bound = bound      # cost of the assignment
+        self.v = v              # column potentials, None unless square
+        self.p = p              # p[j] is the row assigned to column j, None unless square
+
+
+def _augment(cost, u, v, p, i):
+    """
+    Inserts row i into the assignment p along a shortest augmenting path,
+    updating the potentials (e-maxx formulation). Every argument is a plain
+    list: at the sizes of sokoban levels a loop over the columns is several
+    times faster than the same steps on small arrays.
+    """
+    m = len(v) - 1
+    minv = [float('inf')] * (m + 1)
+    used = [False] * (m + 1)
+    way = [0] * (m + 1)
+    p[0] = i
+    j0 = 0
+
+    while True:
+        used[j0] = True
+        i0 = p[j0]
+        row = cost[i0]
+        ui0 = u[i0]
+        delta = float('inf')
+        j1 = 0
+        for j in range(1, m + 1):
+            if used[j]:
+                continue
+            current = row[j] - ui0 - v[j]
+            if current < minv[j]:
+                minv[j] = current
+                way[j] = j0
+            if minv[j] < delta:
+                delta = minv[j]
+                j1 = j
+
+        for j in range(m + 1):
+            if used[j]:
+                u[p[j]] += delta
+                v[j] -= delta
+            else:
+                minv[j] -= delta
+        j0 = j1
+        if p[j0] == 0:
+            break
+
+    while j0:
+        j1 = way[j0]
+        p[j0] = p[j1]
+        j0 = j1
+
+
+class HeuristicEngine():
+    """
+    Lower bound on the number of pushes left to solve a level: every box is
+    matched to its own goal at the minimum total push distance, the push
+    distance of a box to a goal being found by pulling boxes back from the
+    goal on the empty level once. Boxes that can not all reach distinct
+    goals make the bound infinite, a deadlock.
+    Bounds are cached per box set, and the matching of a new box set is
+    repaired from the previous one when few boxes moved, typically one
+    after a push.
+    """
+
+    _cache = {}
+
+    INFINITE = 10 ** 6      # push distance of unreachable goals
+
+    CACHE_SIZE = 20000      # default number of cached matchings of a level, about 1KB each
+
+    def __init__(self, level, cache_size=CACHE_SIZE):
+        self.level = level
+        self.goals = np.flatnonzero(level.goals)
+        self.distances = self._push_distances()
+        # cost row of a box on every square, 1-indexed by goal
+        self.cost_rows = [[0] + column for column in self.distances.T.tolist()]
+        self.matchings = EvaluationCache(cache_size)
+        self.last = None
+
+    @classmethod
+    def for_level(cls, level, cache_size=None):
+        """
+        Returns the shared engine of a level, built on first use. A
+        cache_size resizes its matching cache, None keeps the current size.
+        """
+        engine = cls._cache.get(level)
+        if engine is None:
+            engine = cls._cache[level] = cls(level, cls.CACHE_SIZE if cache_size is None else cache_size)
+        elif cache_size is not None and cache_size != engine.matchings.max_size:
+            engine.resize(cache_size)
+        return engine
+
+    def resize(self, cache_size):
+        """
+        Sets the number of cached matchings, dropping the least recently used ones.
+        """
+        entries = self.matchings.entries
+        self.matchings.max_size = cache_size
+        while len(entries) > cache_size:
+            entries.popitem(last=False)
+
+    def _push_distances(self):
+        """
+        (goals, size) table of the number of pushes needed to bring a box from
+        every square to every goal when no other box is in the way, by a
+        breadth first search of box pulls from every goal.
+        """
+        level = self.level
+        neighbours = level.neighbours
+        distances = np.full((len(self.goals), level.size), self.INFINITE, dtype=np.int64)
+
+        for g, goal in enumerate(self.goals):
+            distances[g, goal] = 0
+            frontier = [goal]
+            while frontier:
+                following = []
+                for square in frontier:
+                    d = distances[g, square] + 1
+                    for direction_id, neighbour in enumerate(neighbours[square]):
+                        # the box on square is pulled to neighbour, the player stands beyond it
+                        if neighbour < 0 or distances[g, neighbour] <= d:
+                            continue
+                        if neighbours[neighbour][direction_id] >= 0:
+                            distances[g, neighbour] = d
+                            following.append(neighbour)
+                frontier = following
+
+        return distances
+
+    def box_key(self, board):
+        """
+        Zobrist hash of the boxes of a board alone.
+        """
+        return board.zobrist ^ self.level.player_keys[board.player]
+
+    def lower_bound(self, board, base=None):
+        """
+        Returns the lower bound of the pushes left to solve the board, or
+        None when it is deadlocked. A matching missing from the cache is
+        repaired from base, e.g. that of the board before a push, or else from
+        the last matching returned.
+        """
+        key = self.box_key(board)
+        matching = self.matchings.get(key)
+        if matching is None:
+            if base is not None:
+                self.last = base
+            matching = self._match(tuple(int(box) for box in np.flatnonzero(board.boxes)))
+            self.matchings.put(key, matching)
+        self.last = matching
+        return matching.bound if matching.bound < self.INFINITE else None
+
+    def value(self, board, scale):
+        """
+        Maps the lower bound to a value in [-1, 1]: 1 when solved, falling
+        towards -1 as the bound grows past scale, and -1 when deadlocked.
+        """
+        bound = self.lower_bound(board)
+        if bound is None:
+            return -1.
+        return 2. * math.exp(-bound / float(scale)) - 1.
+
+    def _costs(self, boxes):
+        """
+        Cost matrix of a box set as a list of rows, row 0 being the dummy one.
+        """
+        return [[0] * (len(self.goals) + 1)] + [self.cost_rows[box] for box in boxes]
+
+    @staticmethod
+    def _solved(boxes, cost, v, p):
+        """
+        Returns the Matching of an assignment, keeping its potentials and
+        assignment only when it is square and can be repaired.
+        """
+        bound = sum(cost[p[j]][j] for j in range(1, len(p)) if p[j])
+        if len(cost) != len(p):
+            return Matching(boxes, bound)
+        return Matching(boxes, bound, np.array(v, dtype=np.int64), np.array(p, dtype=np.int32))
+
+    def _match(self, boxes):
+        """
+        Returns the optimal Matching of a box set, repairing the last one
+        when the box and goal counts are equal and at most half of the
+        boxes moved, or solving it from scratch.
+        """
+        last = self.last
+        n, m = len(boxes), len(self.goals)
+        if last is not None and last.p is not None and len(last.boxes) == n:
+            kept = set(boxes).intersection(last.boxes)
+            if len(kept) * 2 >= n:
+                return self._repair(last, boxes, kept)
+
+        cost = self._costs(boxes)
+        u, v = [0] * (n + 1), [0] * (m + 1)
+        p = [0] * (m + 1)
+        for i in range(1, n + 1):
+            _augment(cost, u, v, p, i)
+        return self._solved(boxes, cost, v, p)
+
+    def _repair(self, last, boxes, kept):
+        """
+        Repairs a square assignment after some boxes moved: the rows of the
+        moved boxes get their new squares and costs, are unassigned and are
+        inserted again from potentials made feasible for their new costs.
+        The row potentials of the other rows are those of their tight
+        assigned edges.
+        """
+        moved = iter(box for box in boxes if box not in kept)
+        rows = list(last.boxes)
+        changed = []
+        for r, box in enumerate(rows):
+            if box not in kept:
+                rows[r] = next(moved)
+                changed.append(r + 1)
+
+        cost = self._costs(rows)
+        v, p = last.v.tolist(), last.p.tolist()
+        u = [0] * len(cost)
+        for j in range(1, len(p)):
+            u[p[j]] = cost[p[j]][j] - v[j]
+        for i in changed:
+            p[p.index(i, 1)] = 0
+            row = cost[i]
+            u[i] = min(row[j] - v[j] for j in range(1, len(v)))
+        for i in changed:
+            _augment(cost, u, v, p, i)
+        return self._solved(tuple(rows), cost, v, p)
@@ -0,0 +1,109 @@
+import copy
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def fold_batchnorm(layer, bn):
+    """
+    Returns a copy of a conv or linear layer whose weights absorb the eval
+    mode BatchNorm that follows it.
+    """
+    fused = copy.deepcopy(layer)
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shape = (-1,) + (1,) * (layer.weight.dim() - 1)
+    bias = layer.bias if layer.bias is not None else torch.zeros_like(bn.running_mean)
+
+    with torch.no_grad():
+        fused.weight.copy_(layer.weight * scale.view(shape))
+        fused.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+
+    return fused
+
+
+class FusedSokobanNN(nn.Module):
+    """
+    Inference only copy of a SokobanNN, with every BatchNorm folded into the
+    preceding conv or linear layer and without dropout.
+    """
+
+    def __init__(self, model):
+        super(FusedSokobanNN, self).__init__()
+        self.board_x, self.board_y = model.board_x, model.board_y
+        self.flat_size = model.args.num_channels * (self.board_x - 4) * (self.board_y - 4)
+
+        self.conv1 = fold_batchnorm(model.conv1, model.bn1)
+        self.conv2 = fold_batchnorm(model.conv2, model.bn2)
+        self.conv3 = fold_batchnorm(model.conv3, model.bn3)
+        self.conv4 = fold_batchnorm(model.conv4, model.bn4)
+
+        self.fc1 = fold_batchnorm(model.fc1, model.fc_bn1)
+        self.fc2 = fold_batchnorm(model.fc2, model.fc_bn2)
+        self.fc3 = copy.deepcopy(model.fc3)
+        self.fc4 = copy.deepcopy(model.fc4)
+
+    def forward(self, s):
+        s = s.view(-1, 1, self.board_x, self.board_y)
+        s = F.relu(self.conv1(s))
+        s = F.relu(self.conv2(s))
+        s = F.relu(self.conv3(s))
+        s = F.relu(self.conv4(s))
+        s = s.view(-1, self.flat_size)
+
+        s = F.relu(self.fc1(s))
+        s = F.relu(self.fc2(s))
+
+        return F.log_softmax(self.fc3(s), dim=1), torch.tanh(self.fc4(s))
+
+
+class InferenceEngine():
+    """
+    Frozen TorchScript graph of a SokobanNN for evaluation, run under
+    torch.inference_mode. Modes:
+        fused: BatchNorm folded into the conv and linear weights
+        int8: fused, with fc1 and fc2 dynamically quantized to int8 (CPU only)
+    """
+
+    MODES = ('fused', 'int8')
+
+    def __init__(self, model, mode, cuda=False):
+        if mode not in self.MODES:
+            raise ValueError("Unknown inference engine {}".format(mode))
+        if mode == 'int8' and cuda:
+            raise ValueError("The int8 inference engine only runs on CPU")
+
+        fused = FusedSokobanNN(model).eval()
+        if mode == 'int8':
+            qconfig = torch.ao.quantization.default_dynamic_qconfig
+            fused = torch.ao.quantization.quantize_dynamic(
+                fused, {'fc1': qconfig, 'fc2': qconfig}, dtype=torch.qint8)
+
+        example = torch.zeros(1, model.board_x, model.board_y)
+        if cuda:
+            example = example.cuda()
+        with torch.no_grad():
+            self.module = torch.jit.freeze(torch.jit.trace(fused, example))
+        self.mode = mode
+
+    def __call__(self, boards):
+        with torch.inference_mode():
+            return self.module(boards)
+
+
+def check_accuracy(model, engine, boards):
+    """
+    Compares an engine with the float model on a batch of boards.
+    Returns the largest absolute differences of the policy probabilities and
+    of the values.
+    """
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        pi, v = model(boards)
+    pi_engine, v_engine = engine(boards)
+    model.train(was_training)
+
+    return {
+        'max_pi_error': (torch.exp(pi) - torch.exp(pi_engine)).abs().max().item(),
+        'max_v_error': (v - v_engine).abs().max().item(),
+    }
@@ -0,0 +1,141 @@
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class Metrics():
+    """
+    Timers and counters of one iteration. A timer sums the seconds and the
+    calls of a phase, a counter sums values. Instrumented code holds None
+    instead of a Metrics when instrumentation is disabled and skips its
+    hooks, timing calls included.
+    """
+
+    def __init__(self):
+        self.timers = {}        # name -> [calls, seconds]
+        self.counters = {}      # name -> value
+
+    def add_time(self, name, seconds, calls=1):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = [0, 0.]
+        timer[0] += calls
+        timer[1] += seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+
+    def snapshot(self):
+        """
+        Returns the timers and counters as plain dicts, e.g. to send them from
+        a worker process.
+        """
+        return {'timers': {name: {'calls': calls, 'seconds': seconds}
+                           for name, (calls, seconds) in self.timers.items()},
+                'counters': dict(self.counters)}
+
+    def merge(self, snapshot, prefix=''):
+        """
+        Adds the timers and counters of a snapshot, e.g. those of a worker
+        process, their names prefixed with prefix.
+        """
+        for name, timer in snapshot['timers'].items():
+            self.add_time(prefix + name, timer['seconds'], timer['calls'])
+        for name, value in snapshot['counters'].items():
+            self.count(prefix + name, value)
+
+    def summary(self):
+        """
+        Returns the snapshot with the hit rates of every counter pair
+        name.hits and name.misses.
+        """
+        summary = self.snapshot()
+        rates = {}
+        for name, hits in self.counters.items():
+            if name.endswith('.hits'):
+                prefix = name[:-len('.hits')]
+                lookups = hits + self.counters.get(prefix + '.misses', 0)
+                rates[prefix] = hits / float(lookups) if lookups else 0.
+        summary['hit_rates'] = rates
+        return summary
+
+
+class MetricsExporter():
+    """
+    Writes the metrics of every iteration either as one JSON line appended to
+    a file ('jsonl'), or as a Prometheus text file replaced at every iteration
+    ('prometheus'), e.g. for the node exporter textfile collector.
+    """
+
+    FORMATS = ('jsonl', 'prometheus')
+
+    def __init__(self, path, fmt='jsonl'):
+        if fmt not in self.FORMATS:
+            raise ValueError("Unknown metrics format {}".format(fmt))
+        self.path = path
+        self.fmt = fmt
+
+    def write(self, iteration, metrics):
+        summary = metrics.summary()
+        if self.fmt == 'jsonl':
+            summary['iteration'] = iteration
+            summary['time'] = time.time()
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(summary) + '\n')
+            return
+
+        lines = ['# TYPE sokoban_iteration gauge',
+                 'sokoban_iteration {}'.format(iteration),
+                 '# TYPE sokoban_phase_seconds gauge',
+                 '# TYPE sokoban_phase_calls gauge']
+        for name, timer in sorted(summary['timers'].items()):
+            lines.append('sokoban_phase_seconds{{phase="{}"}} {}'.format(name, timer['seconds']))
+            lines.append('sokoban_phase_calls{{phase="{}"}} {}'.format(name, timer['calls']))
+        lines.append('# TYPE sokoban_count gauge')
+        for name, value in sorted(summary['counters'].items()):
+            lines.append('sokoban_count{{name="{}"}} {}'.format(name, value))
+        lines.append('# TYPE sokoban_hit_rate gauge')
+        for name, rate in sorted(summary['hit_rates'].items()):
+            lines.append('sokoban_hit_rate{{cache="{}"}} {}'.format(name, rate))
+
+        with open(self.path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(self.path + '.tmp', self.path)
+
+
+def profile_call(fn, prefix, memory=False):
+    """
+    Runs fn under cProfile, writing its stats to prefix.prof, and with memory
+    set under tracemalloc, writing the top allocation sites to
+    prefix.tracemalloc.txt. Returns the result of fn.
+    """
+    if memory:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    try:
+        result = profiler.runcall(fn)
+    finally:
+        profiler.dump_stats(prefix + '.prof')
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            with open(prefix + '.tracemalloc.txt', 'w') as f:
+                for stat in snapshot.statistics('lineno')[:50]:
+                    f.write(str(stat) + '\n')
+    print("Profile written to", prefix + '.prof')
+    return result
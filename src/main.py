@@ -1,14 +1,15 @@
-from sokobanGame import Sokoban as game
+from sokobanGame import Sokoban, SokobanDirectional, SokobanPush
 import argparse
 from nnwrapper import NNetWrapper as nn
 from coach import Coach
 import torch
 import os
-import sys
 
 
-if __name__ == "__main__":
-    description = "Sokoban Solver"
+def get_parser(description="Sokoban Solver"):
+    """
+    Returns the argument parser shared by the training and solving entry points.
+    """
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('-lr', '--learning_rate', dest="lr",
                         type=float, default=0.001, help="Learning Rate")
@@ -34,7 +35,29 @@ if __name__ == "__main__":
                         dest='numMCTSSims', default=25)
     parser.add_argument("-aComp", "--arenaCompare", type=int,
                         dest='arenaCompare', default=40)
+    parser.add_argument('-aworkers', '--arena_workers', type=int, dest='numArenaWorkers', default=1,
+                        help="Number of worker processes playing the arena games")
+    parser.add_argument('-amargin', '--arena_margin', type=float, dest='arenaMargin', default=0.1,
+                        help="Solve rate margin around updateThreshold of the early stopping test, 0 to play every game")
+    parser.add_argument('-aerror', '--arena_error', type=float, dest='arenaError', default=0.05,
+                        help="Error rate of the early stopping arena test")
     parser.add_argument('-cpuct', '--cpuct', type=int, dest='cpuct', default=1)
+    parser.add_argument('-maxdepth', '--max_search_depth', type=int, dest='maxSearchDepth', default=1000,
+                        help="Maximum depth of an MCTS descent")
+    parser.add_argument('-depthv', '--depth_exceeded_value', type=float, dest='depthExceededValue', default=0.0,
+                        help="Value backed up by a descent that reaches the maximum depth")
+    parser.add_argument('-maxnodes', '--mcts_max_nodes', type=int, dest='mctsMaxNodes', default=0,
+                        help="Maximum number of nodes kept by MCTS, 0 for no limit")
+    parser.add_argument('-maxbytes', '--mcts_max_bytes', type=int, dest='mctsMaxBytes', default=0,
+                        help="Approximate maximum bytes of MCTS node statistics, 0 for no limit")
+    parser.add_argument('-evict', '--mcts_eviction', dest='mctsEviction', default='lru',
+                        choices=['lru', 'visits'], help="MCTS node eviction policy")
+    parser.add_argument('-mctsbs', '--mcts_batch_size', type=int, dest='mctsBatchSize', default=1,
+                        help="Number of MCTS leaves evaluated together by the network")
+    parser.add_argument('-vloss', '--virtual_loss', type=float, dest='virtualLoss', default=1.0,
+                        help="Virtual loss applied to pending edges in batched MCTS")
+    parser.add_argument('-zdebug', '--zobrist_debug', dest='zobristDebug', action='store_true',
+                        help="Check every MCTS state hash against the board string for collisions")
     parser.add_argument('-cp', '--checkpoint',
                         dest='checkpoint', type=str, default='./temp/')
     parser.add_argument('-cuda', '--cuda', dest='cuda', action='store_true',
@@ -45,22 +68,93 @@ if __name__ == "__main__":
                         dest='load_folder_file', type=str)
     parser.add_argument('-iterexamp', '--num_iters_example',
                         dest='numItersForTrainExamplesHistory', type=int, default=20)
-    args = parser.parse_args()
+    parser.add_argument('-push', '--push_level', dest='pushLevel', action='store_true',
+                        help="Play with box pushes as actions instead of single steps")
+    parser.add_argument('-evcache', '--eval_cache_size', dest='evalCacheSize', type=int, default=100000,
+                        help="Number of network evaluations kept in the LRU cache, 0 to disable")
+    parser.add_argument('-engine', '--inference_engine', dest='inferenceEngine', default='eager',
+                        choices=['eager', 'fused', 'int8'], help="Network inference engine")
+    parser.add_argument('-dir', '--directional', dest='directional', action='store_true',
+                        help="Use a 4 directions plus pass action head instead of one action per square")
+    parser.add_argument('-workers', '--num_workers', dest='numSelfPlayWorkers', type=int, default=1,
+                        help="Number of self-play worker processes")
+    parser.add_argument('-seed', '--seed', dest='seed', type=int, default=None,
+                        help="Seed of the self-play episodes")
+    parser.add_argument('-movems', '--move_time_ms', dest='moveTimeMs', type=float, default=0,
+                        help="Per move MCTS deadline in milliseconds, 0 to run numMCTS simulations")
+    parser.add_argument('-puzzlems', '--puzzle_time_ms', dest='puzzleTimeMs', type=float, default=0,
+                        help="Per puzzle MCTS time budget in milliseconds, split across moves")
+    parser.add_argument('-movestogo', '--moves_to_go', dest='movesToGo', type=int, default=30,
+                        help="Share of the remaining puzzle budget given to a move is 1/movesToGo")
+    parser.add_argument('-convtol', '--convergence_tol', dest='convergenceTol', type=float, default=0.01,
+                        help="Timed searches stop once the root visit distribution moves less than this, 0 to disable")
+    parser.add_argument('-convevery', '--convergence_every', dest='convergenceEvery', type=int, default=32,
+                        help="Number of simulations between two convergence checks")
+    parser.add_argument('-hweight', '--heuristic_weight', dest='heuristicWeight', type=float, default=0.0,
+                        help="Weight of the heuristic lower bound in the MCTS leaf values, 0 to disable")
+    parser.add_argument('-hscale', '--heuristic_scale', dest='heuristicScale', type=float, default=20.0,
+                        help="Push scale of the heuristic value 2 * exp(-bound / scale) - 1")
+    parser.add_argument('-hcache', '--heuristic_cache_size', dest='heuristicCacheSize', type=int, default=20000,
+                        help="Matchings of the heuristic cached per level and process, about 1KB each")
+    parser.add_argument('-metrics', '--metrics_file', dest='metricsFile', type=str, default=None,
+                        help="File receiving the instrumentation metrics of every iteration, none to disable them")
+    parser.add_argument('-metricsfmt', '--metrics_format', dest='metricsFormat', default='jsonl',
+                        choices=['jsonl', 'prometheus'], help="JSON lines appended per iteration or a Prometheus text file")
+    parser.add_argument('-profiter', '--profile_iteration', dest='profileIteration', type=int, default=0,
+                        help="Iteration of the self-play episode run under cProfile, 0 to disable")
+    parser.add_argument('-profep', '--profile_episode', dest='profileEpisode', type=int, default=0,
+                        help="Episode of profileIteration run under cProfile")
+    parser.add_argument('-profmem', '--profile_memory', dest='profileMemory', action='store_true', default=False,
+                        help="Also trace the memory allocations of the profiled episode")
+    parser.add_argument('-bootstrap', '--expert_bootstrap', dest='expertBootstrap', action='store_true', default=False,
+                        help="Train on the solution of the A*/IDA* solver before the first self-play iteration")
+    parser.add_argument('-solver', '--solver_algorithm', dest='solverAlgorithm', default='astar',
+                        choices=['astar', 'idastar'], help="Search algorithm of the solver")
+    parser.add_argument('-solvernodes', '--solver_nodes', dest='solverNodes', type=int, default=1000000,
+                        help="Expanded states before the solver gives up, 0 for no limit")
+    parser.add_argument('-solversec', '--solver_seconds', dest='solverSeconds', type=float, default=600,
+                        help="Seconds before the solver gives up, 0 for no limit")
+    parser.add_argument('-solverweight', '--solver_weight', dest='solverWeight', type=float, default=1.0,
+                        help="Weight of the solver lower bound, above 1 to trade optimal solutions for speed")
+    parser.add_argument('-puzzle', '--puzzle', dest='puzzle', type=str,
+                        default=os.path.join("..", "data", "puzzle1.txt"), help="Puzzle file")
+    return parser
+
 
-    fh = open(os.path.join("..", "data", "puzzle1.txt"))
+def make_game(args):
+    """
+    Returns the game of the puzzle file, in the action space selected by args.
+    """
+    fh = open(args.puzzle)
     fcontent = fh.read()
     fh.close()
 
-    sys.setrecursionlimit(10000)
-    g = game(fcontent)
+    if args.pushLevel:
+        game = SokobanPush
+    elif args.directional:
+        game = SokobanDirectional
+    else:
+        game = Sokoban
+    return game(fcontent)
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+
+    g = make_game(args)
 
     nnet = nn(g, args)
 
     if args.load_model:
         nnet.load_checkpoint(args.load_folder_file)
 
+    if args.inferenceEngine != 'eager':
+        print("Inference engine", args.inferenceEngine, nnet.check_inference_engine())
+
     c = Coach(g, nnet, args)
     if args.load_model:
         print("Load trainExamples from file")
         c.loadTrainExamples()
+    if args.expertBootstrap:
+        c.bootstrap()
     c.learn()
\ No newline at end of file
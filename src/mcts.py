@@ -1,38 +1,83 @@
-import math
 import numpy as np
-import sys
+import time
+from heuristic import HeuristicEngine
+from nodestore import Node, make_node_store
 
 
-class MCTS():
-    EPS = 1e-8
+class PuzzleClock():
+    """
+    Splits a per puzzle time budget across moves: every move gets the
+    remaining time divided by movesToGo.
+    """
+
+    def __init__(self, budget_ms, moves_to_go):
+        self.end = time.time() + budget_ms / 1000.
+        self.moves_to_go = max(1, moves_to_go)
+
+    def remaining(self):
+        return max(0., self.end - time.time())
+
+    def expired(self):
+        return self.remaining() == 0.
+
+    def move_deadline(self, move_ms=0):
+        """
+        Returns the deadline of the next move, capped by a per move limit.
+        """
+        share = self.remaining() / self.moves_to_go
+        if move_ms > 0:
+            share = min(share, move_ms / 1000.)
+        return time.time() + share
+
 
-    def __init__(self, game, nnet, args):
+class MCTS():
+    def __init__(self, game, nnet, args, metrics=None):
         self.game = game
         self.nnet = nnet
         self.args = args
-        self.Qsa = {}       # stores Q values for s,a (as defined in the paper)
-        self.Nsa = {}       # stores #times edge s,a was visited
-        self.Ns = {}        # stores #times board s was visited
-        self.Ps = {}        # stores initial policy (returned by neural net)
+        self.metrics = metrics          # instrumentation.Metrics of the search phases, None when disabled
+        self.nodes = make_node_store(args)    # stores the expanded Node of every board s
+
+        self.Ks = {}        # stores the string of every hashed board s (zobristDebug only)
+
+        self.clock = None               # PuzzleClock of the current puzzle, if puzzleTimeMs is set
+        self.last_simulations = 0       # simulations run by the last simulate
+
+    def start_puzzle(self):
+        """
+        Starts the time budget of a new puzzle.
+        """
+        if self.args.puzzleTimeMs > 0:
+            self.clock = PuzzleClock(self.args.puzzleTimeMs, self.args.movesToGo)
 
-        self.Es = {}        # stores game.getGameEnded ended for board s
-        self.Vs = {}        # stores game.getValidMoves for board s
+    def move_deadline(self):
+        """
+        Returns the deadline of the next move, or None when the search is not
+        timed and runs numMCTSSims simulations.
+        """
+        if self.clock is not None:
+            return self.clock.move_deadline(self.args.moveTimeMs)
+        if self.args.moveTimeMs > 0:
+            return time.time() + self.args.moveTimeMs / 1000.
+        return None
 
     def getActionProb(self, canonicalBoard, temp=1):
         """
         This function performs numMCTSSims simulations of MCTS starting from
-        canonicalBoard.
+        canonicalBoard, or with a move deadline, as many as fit before it.
         Returns:
             probs: a policy vector where the probability of the ith action is
                    proportional to Nsa[(s,a)]**(1./temp)
         """
-        for _ in range(self.args.numMCTSSims):
-            self.search(canonicalBoard)
+        self.simulate(canonicalBoard, self.move_deadline())
 
-        s = self.game.string_representation(canonicalBoard)
-
-        counts = [self.Nsa[(s, a)] if (s, a) in self.Nsa else 0 for a in range(
-            self.game.get_action_size())]
+        s = self.state_key(canonicalBoard)
+        node = self.nodes.get(s)
+        counts = node.counts(self.game.get_action_size()) if node is not None \
+            else np.zeros(self.game.get_action_size(), dtype=np.int64)
+        if counts.sum() == 0:
+            # no visited edge, e.g. a terminal root: every valid move is as good
+            counts = np.asarray(self.game.get_valid_moves(canonicalBoard), dtype=np.int64)
 
         if temp == 0:
             bestA = np.argmax(counts)
@@ -40,83 +85,273 @@ class MCTS():
             probs[bestA] = 1
             return probs
 
-        counts = [x ** (1. / temp) for x in counts]
-        probs = [x / float(sum(counts)) for x in counts]
-        return probs
+        counts = counts ** (1. / temp)
+        probs = counts / float(np.sum(counts))
+        return probs.tolist()
+
+    def simulate(self, canonicalBoard, deadline=None):
+        """
+        Runs the simulations of one move from canonicalBoard: numMCTSSims of
+        them, or when a deadline (a time.time() value) is given, as many as fit
+        before it, the root getting at least one visited edge. A timed search
+        also stops early once the root visit
+        distribution has converged: its best action is unchanged and it moved
+        by less than convergenceTol (L1) over the last convergenceEvery
+        simulations. Returns the number of simulations, also kept in
+        last_simulations.
+        """
+        batch_size = max(1, self.args.mctsBatchSize)
+        s = self.state_key(canonicalBoard)
+        self.nodes.pin(s)
+        sims = 0
+        next_check = self.args.convergenceEvery
+        previous = None
+
+        while True:
+            if deadline is None:
+                if sims >= self.args.numMCTSSims:
+                    break
+                n = min(batch_size, self.args.numMCTSSims - sims)
+            else:
+                root = self.nodes.get(s)
+                if time.time() >= deadline and root is not None and (root.visits > 0 or root.ended != 0):
+                    break
+                n = batch_size
+
+            if n > 1:
+                self.search_batch(canonicalBoard, n)
+            else:
+                self.search(canonicalBoard)
+            sims += n
+
+            if deadline is not None and self.args.convergenceTol > 0 and sims >= next_check:
+                next_check = sims + self.args.convergenceEvery
+                node = self.nodes.get(s)
+                if node is not None and node.N.sum() > 0:
+                    distribution = node.N / float(node.N.sum())
+                    if previous is not None and np.argmax(distribution) == np.argmax(previous) and \
+                            np.abs(distribution - previous).sum() < self.args.convergenceTol:
+                        break
+                    previous = distribution
+
+        self.last_simulations = sims
+        return sims
+
+    def state_key(self, canonicalBoard):
+        """
+        Returns the transposition key of a board, its Zobrist hash.
+        With zobristDebug set, every key is checked against the string
+        representation of the board it was first seen with.
+        """
+        s = self.game.hash_representation(canonicalBoard)
+
+        if self.args.zobristDebug:
+            string = self.game.string_representation(canonicalBoard)
+            if self.Ks.setdefault(s, string) != string:
+                raise AssertionError("Zobrist hash collision on key {:016x}".format(s))
 
-    def search(self, canonicalBoard, depth=0):
+        return s
+
+    def expand(self, canonicalBoard, ps):
+        """
+        Builds the Node of a non terminal board from the network policy ps,
+        restricted to the legal actions of the board.
         """
-        This function performs one iteration of MCTS. It is recursively called
+        actions = np.flatnonzero(self.game.get_valid_moves(canonicalBoard))
+        priors = np.asarray(ps, dtype=np.float64)[actions]   # masking invalid moves
+        sum_priors = np.sum(priors)
+        if sum_priors > 0:
+            priors /= sum_priors    # renormalize
+        else:
+            # if all valid moves were masked make all valid moves equally probable
+
+            # NB! All valid moves may be masked if either your NNet architecture is insufficient or you've get overfitting or something else.
+            # If you have got dozens or hundreds of these messages you should pay attention to your NNet and/or training process.
+            print("All valid moves were masked, do workaround.")
+            priors = np.full(len(actions), 1. / len(actions))
+
+        return Node(actions, priors)
+
+    def leaf_value(self, canonicalBoard, v):
+        """
+        Returns the value of a new leaf: the network value, blended with
+        weight heuristicWeight with the value of the heuristic lower bound.
+        """
+        v = float(np.asarray(v).reshape(-1)[0])
+        weight = self.args.heuristicWeight
+        if weight > 0:
+            engine = HeuristicEngine.for_level(canonicalBoard.level, self.args.heuristicCacheSize)
+            prior = engine.value(canonicalBoard, self.args.heuristicScale)
+            v = (1 - weight) * v + weight * prior
+        return v
+
+    def search(self, canonicalBoard):
+        """
+        This function performs one iteration of MCTS. It descends from
+        canonicalBoard, keeping the edges taken on an explicit path stack,
         till a leaf node is found. The action chosen at each node is one that
         has the maximum upper confidence bound as in the paper.
         Once a leaf node is found, the neural network is called to return an
         initial policy P and a value v for the state. This value is propogated
         up the search path. In case the leaf node is a terminal state, the
-        outcome is propogated up the search path. The values of Ns, Nsa, Qsa are
-        updated.
-            v: the negative of the value of the current canonicalBoard
-        """
-
-        s = self.game.string_representation(canonicalBoard)
-
-        if s not in self.Es:
-            self.Es[s] = self.game.has_puzzle_ended(canonicalBoard)
-        if self.Es[s] != 0 or depth > sys.getrecursionlimit() - 100:
-            # terminal node
-            return -self.Es[s]
-
-        if s not in self.Ps:
-            # leaf node
-            self.Ps[s], v = self.nnet.predict(canonicalBoard)
-            valids = self.game.get_valid_moves(canonicalBoard)
-            self.Ps[s] = self.Ps[s] * valids      # masking invalid moves
-            sum_Ps_s = np.sum(self.Ps[s])
-            if sum_Ps_s > 0:
-                self.Ps[s] /= sum_Ps_s    # renormalize
-            else:
-                # if all valid moves were masked make all valid moves equally probable
-
-                # NB! All valid moves may be masked if either your NNet architecture is insufficient or you've get overfitting or something else.
-                # If you have got dozens or hundreds of these messages you should pay attention to your NNet and/or training process.
-                print("All valid moves were masked, do workaround.")
-                self.Ps[s] = self.Ps[s] + valids
-                self.Ps[s] /= np.sum(self.Ps[s])
-
-            self.Vs[s] = valids
-            self.Ns[s] = 0
-            return -v
-
-        valids = self.Vs[s]
-        cur_best = -float('inf')
-        best_act = -1
-
-        # pick the action with the highest upper confidence bound
-        for a in range(self.game.get_action_size()):
-            if valids[a]:
-                if (s, a) in self.Qsa:
-                    u = self.Qsa[(s, a)] + self.args.cpuct * self.Ps[s][a] * \
-                        math.sqrt(self.Ns[s]) / (1 + self.Nsa[(s, a)])
+        outcome is propogated up the search path. A descent that reaches
+        maxSearchDepth stops there with depthExceededValue. The node statistics
+        are updated with vectorized operations over the legal actions only, and
+        canonicalBoard is restored to its original state.
+        As the puzzle has a single player the value is not negated between plies.
+            v: the value of the current canonicalBoard
+        """
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        leaf = None
+        evaluation = 0.
+
+        path = []       # (node, i) edges taken from canonicalBoard
+
+        while True:
+            s = self.state_key(canonicalBoard)
+            node = self.nodes.get(s)
+
+            if node is None:
+                if metrics is not None:
+                    leaf = time.perf_counter()
+                ended = self.game.has_puzzle_ended(canonicalBoard)
+                if ended != 0:
+                    # terminal node
+                    self.nodes.add(s, Node.terminal(ended))
+                    v = ended
                 else:
-                    u = self.args.cpuct * self.Ps[s][a] * \
-                        math.sqrt(self.Ns[s] + self.EPS)     # Q = 0 ?
+                    # leaf node
+                    if metrics is not None:
+                        evaluation = time.perf_counter()
+                    ps, v = self.nnet.predict(canonicalBoard)
+                    if metrics is not None:
+                        evaluation = time.perf_counter() - evaluation
+                    self.nodes.add(s, self.expand(canonicalBoard, ps))
+                    v = self.leaf_value(canonicalBoard, v)
+                break
 
-                if u > cur_best:
-                    cur_best = u
-                    best_act = a
+            if node.ended != 0:
+                # terminal node
+                v = node.ended
+                break
 
-        a = best_act
-        next_s = self.game.get_next_state(canonicalBoard, a)
+            if len(path) >= self.args.maxSearchDepth:
+                v = self.args.depthExceededValue
+                break
 
-        v = self.search(next_s, depth + 1)
+            # pick the action with the highest upper confidence bound
+            i = node.select(self.args.cpuct)
+            self.game.push_action(canonicalBoard, int(node.actions[i]))
+            path.append((node, i))
 
-        if (s, a) in self.Qsa:
-            self.Qsa[(s, a)] = (self.Nsa[(s, a)] *
-                                self.Qsa[(s, a)] + v)/(self.Nsa[(s, a)]+1)
-            self.Nsa[(s, a)] += 1
+        if metrics is not None:
+            expanded = time.perf_counter()
+            if leaf is None:
+                leaf = expanded
 
-        else:
-            self.Qsa[(s, a)] = v
-            self.Nsa[(s, a)] = 1
+        for node, i in reversed(path):
+            self.game.pop_action(canonicalBoard)
+            node.backup(i, v)
+
+        if metrics is not None:
+            self._record(metrics, 1, leaf - start, expanded - leaf - evaluation, evaluation,
+                         time.perf_counter() - expanded, len(path))
+        return v
+
+    @staticmethod
+    def _record(metrics, simulations, selection, expansion, evaluation, backup, depth):
+        metrics.add_time('mcts.selection', selection)
+        metrics.add_time('mcts.expansion', expansion)
+        metrics.add_time('mcts.evaluation', evaluation)
+        metrics.add_time('mcts.backup', backup)
+        metrics.count('mcts.simulations', simulations)
+        metrics.count('mcts.depth', depth)
+
+    def search_batch(self, canonicalBoard, batch_size):
+        """
+        Performs batch_size simulations of MCTS from canonicalBoard whose leaves
+        are evaluated together by a single nnet.predict_batch call.
+        Every descent walks canonicalBoard forward with push_action and restores
+        it with pop_action, copying the board only at a new leaf. It applies a
+        virtual loss on the edges it takes, so that the following descents of
+        the round diverge instead of reaching the same leaf. Once the batch is
+        evaluated the virtual losses are reverted and every path is backed up.
+        """
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        evaluation = 0.
+
+        loss = self.args.virtualLoss
+        backups = []        # (path, value) of every finished descent
+        pending = {}        # leaf s -> (board, paths waiting for its evaluation)
+
+        board = canonicalBoard
+        for _ in range(batch_size):
+            path = []
+
+            while True:
+                s = self.state_key(board)
+                node = self.nodes.get(s)
+
+                if node is None:
+                    ended = self.game.has_puzzle_ended(board)
+                    if ended != 0:
+                        # terminal node
+                        self.nodes.add(s, Node.terminal(ended))
+                        backups.append((path, ended))
+                    elif s in pending:
+                        # another descent of this round reached the same leaf
+                        pending[s][1].append(path)
+                    else:
+                        # leaf node
+                        pending[s] = (board.copy(), [path])
+                    break
+
+                if node.ended != 0:
+                    # terminal node
+                    backups.append((path, node.ended))
+                    break
+
+                if len(path) >= self.args.maxSearchDepth:
+                    backups.append((path, self.args.depthExceededValue))
+                    break
+
+                i = node.select(self.args.cpuct)
+                node.apply_virtual_loss(i, loss)
+                path.append((node, i))
+                self.game.push_action(board, int(node.actions[i]))
+
+            for _ in path:
+                self.game.pop_action(board)
+
+        if metrics is not None:
+            leaf = time.perf_counter()
+
+        if pending:
+            keys = list(pending)
+            if metrics is not None:
+                evaluation = time.perf_counter()
+            pis, vs = self.nnet.predict_batch([pending[s][0] for s in keys])
+            if metrics is not None:
+                evaluation = time.perf_counter() - evaluation
+                metrics.count('mcts.batch_leaves', len(keys))
+            for s, ps, v in zip(keys, pis, vs):
+                board, paths = pending[s]
+                self.nodes.add(s, self.expand(board, ps))
+                v = self.leaf_value(board, v)
+                backups.extend((path, v) for path in paths)
+
+        if metrics is not None:
+            expanded = time.perf_counter()
+
+        for path, v in backups:
+            for node, i in path:
+                node.revert_virtual_loss(i, loss)
+                node.backup(i, v)
 
-        self.Ns[s] += 1
-        return -v
+        if metrics is not None:
+            self._record(metrics, batch_size, leaf - start, expanded - leaf - evaluation, evaluation,
+                         time.perf_counter() - expanded, sum(len(path) for path, _ in backups))
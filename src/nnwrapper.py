@@ -6,25 +6,50 @@ import sys
 sys.path.append('pytorch_classification')
 from pytorch_classification.utils import Bar, AverageMeter
 import time
-from torch.autograd import Variable
 import os
+from evalcache import EvaluationCache
+from inference import InferenceEngine, check_accuracy
+from batchPipeline import BatchPipeline
 
 
 class NNetWrapper():
     def __init__(self, game, args):
         self.nnet = SokobanNN(game, args)
+        self.game = game
         self.board_x, self.board_y = game.get_board_size()
         self.action_size = game.get_action_size()
         self.args = args
 
+        # evaluations are cached per model version, bumped whenever the weights change
+        self.model_version = 0
+        self.cache = EvaluationCache(args.evalCacheSize) if args.evalCacheSize > 0 else None
+        # compiled inference graph, rebuilt from the current weights on first use
+        self.engine = None
+        # instrumentation.Metrics of the training phases, None when disabled
+        self.metrics = None
+
         if args.cuda:
             self.nnet.cuda()
 
+    def weights_changed(self):
+        """
+        Invalidates the cached evaluations of the previous weights.
+        """
+        self.model_version += 1
+        self.engine = None
+        if self.cache is not None:
+            self.cache.clear()
+
     def train(self, examples):
         """
-        form (board, pi, v)
+        examples: compact Examples of (board, pi, v), or a replay view of them.
+        Every epoch goes once over the examples in a random order, each one
+        transformed by a random symmetry of the game, with the batches made
+        dense and prefetched by a BatchPipeline.
         """
         optimizer = optim.Adam(self.nnet.parameters())
+        pipeline = BatchPipeline(examples, self.game, self.args.batch_size)
+        self.weights_changed()
 
         for epoch in range(self.args.epochs):
             print('EPOCH ::: ' + str(epoch+1))
@@ -35,24 +60,18 @@ class NNetWrapper():
             v_losses = AverageMeter()
             end = time.time()
 
-            bar = Bar('Training Net', max=int(
-                len(examples) / self.args.batch_size))
+            bar = Bar('Training Net', max=len(pipeline))
             batch_idx = 0
 
-            while batch_idx < int(len(examples) / self.args.batch_size):
-                sample_ids = np.random.randint(
-                    len(examples), size=self.args.batch_size)
-                boards, pis, vs = list(zip(*[examples[i] for i in sample_ids]))
-                boards = torch.FloatTensor(np.array(boards).astype(np.float64))
-                target_pis = torch.FloatTensor(np.array(pis))
-                target_vs = torch.FloatTensor(np.array(vs).astype(np.float64))
+            for boards, pis, vs in pipeline.epoch():
+                boards = torch.from_numpy(boards)
+                target_pis = torch.from_numpy(pis)
+                target_vs = torch.from_numpy(vs)
 
                 # predict
                 if self.args.cuda:
                     boards, target_pis, target_vs = boards.contiguous().cuda(
                     ), target_pis.contiguous().cuda(), target_vs.contiguous().cuda()
-                boards, target_pis, target_vs = Variable(
-                    boards), Variable(target_pis), Variable(target_vs)
 
                 # measure data loading time
                 data_time.update(time.time() - end)
@@ -64,8 +83,8 @@ class NNetWrapper():
                 total_loss = l_pi + l_v
 
                 # record loss
-                pi_losses.update(l_pi.data[0], boards.size(0))
-                v_losses.update(l_v.data[0], boards.size(0))
+                pi_losses.update(l_pi.item(), boards.size(0))
+                v_losses.update(l_v.item(), boards.size(0))
 
                 # compute gradient and do SGD step
                 optimizer.zero_grad()
@@ -80,7 +99,7 @@ class NNetWrapper():
                 # plot progress
                 bar.suffix = '({batch}/{size}) Data: {data:.3f}s | Batch: {bt:.3f}s | Total: {total:} | ETA: {eta:} | Loss_pi: {lpi:.4f} | Loss_v: {lv:.3f}'.format(
                     batch=batch_idx,
-                    size=int(len(examples) / self.args.batch_size),
+                    size=len(pipeline),
                     data=data_time.avg,
                     bt=batch_time.avg,
                     total=bar.elapsed_td,
@@ -91,25 +110,111 @@ class NNetWrapper():
                 bar.next()
             bar.finish()
 
+            if self.metrics is not None:
+                self.metrics.add_time('train.data', data_time.sum, data_time.count)
+                self.metrics.add_time('train.compute', batch_time.sum - data_time.sum, batch_time.count)
+                self.metrics.count('train.samples', pi_losses.count)
+
     def predict(self, board):
         """
         board: np array with board
         """
+        if self.cache is not None:
+            key = (board.zobrist, self.model_version)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
         # timing
         #start = time.time()
 
         # preparing input
-        board = torch.FloatTensor(board.board.astype(np.float64))
+        board = torch.from_numpy(board.board.astype(np.float32))
         if self.args.cuda:
             board = board.contiguous().cuda()
-        board = Variable(board, volatile=True)
         board = board.view(1, self.board_x, self.board_y)
 
-        self.nnet.eval()
-        pi, v = self.nnet(board)
+        pi, v = self.forward(board)
 
         #print('PREDICTION TIME TAKEN : {0:03f}'.format(time.time() - start))
-        return torch.exp(pi).data.cpu().numpy()[0], v.data.cpu().numpy()[0]
+        result = torch.exp(pi).cpu().numpy()[0], v.cpu().numpy()[0]
+        if self.cache is not None:
+            self.cache.put(key, result)
+        return result
+
+    def predict_batch(self, boards):
+        """
+        boards: list of boards, evaluated in a single forward pass
+        Returns:
+            pis: (len(boards), action_size) np array of policies
+            vs: (len(boards),) np array of values
+        """
+        pis = np.empty((len(boards), self.action_size), dtype=np.float32)
+        vs = np.empty(len(boards), dtype=np.float32)
+        missing = list(range(len(boards)))
+
+        if self.cache is not None:
+            keys = [(board.zobrist, self.model_version) for board in boards]
+            missing = []
+            for i, key in enumerate(keys):
+                cached = self.cache.get(key)
+                if cached is None:
+                    missing.append(i)
+                else:
+                    pis[i], vs[i] = cached[0], cached[1][0]
+            if not missing:
+                return pis, vs
+
+        pis[missing], vs[missing] = self.predict_encoded(
+            np.stack([boards[i].board for i in missing]).astype(np.float32))
+
+        if self.cache is not None:
+            for i in missing:
+                self.cache.put(keys[i], (pis[i].copy(), vs[i:i + 1].copy()))
+
+        return pis, vs
+
+    def predict_encoded(self, batch):
+        """
+        batch: (n, width, height) float32 np array of board encodings, such as
+               vectorEnv.VectorSokoban.encode, evaluated without the cache
+        Returns:
+            pis: (n, action_size) np array of policies
+            vs: (n,) np array of values
+        """
+        batch = torch.from_numpy(batch)
+        if self.args.cuda:
+            batch = batch.contiguous().cuda()
+        batch = batch.view(-1, self.board_x, self.board_y)
+
+        pi, v = self.forward(batch)
+
+        return torch.exp(pi).cpu().numpy(), v.cpu().numpy().reshape(-1)
+
+    def forward(self, boards):
+        """
+        Evaluates a batch of board tensors with the selected inference engine:
+        the eager float model, or a compiled 'fused' or 'int8' graph.
+        """
+        if self.args.inferenceEngine == 'eager':
+            if self.nnet.training:
+                self.nnet.eval()
+            with torch.inference_mode():
+                return self.nnet(boards)
+
+        if self.engine is None:
+            self.engine = InferenceEngine(self.nnet, self.args.inferenceEngine, self.args.cuda)
+        return self.engine(boards)
+
+    def check_inference_engine(self, num_boards=16):
+        """
+        Compares the selected inference engine with the float model on random boards.
+        """
+        boards = torch.randint(0, 7, (num_boards, self.board_x, self.board_y)).float()
+        if self.args.cuda:
+            boards = boards.cuda()
+        engine = InferenceEngine(self.nnet, self.args.inferenceEngine, self.args.cuda)
+        return check_accuracy(self.nnet, engine, boards)
 
     def loss_pi(self, targets, outputs):
         return -torch.sum(targets * outputs) / targets.size()[0]
@@ -134,3 +239,4 @@ class NNetWrapper():
             raise("No model in path {}".format(fname))
         checkpoint = torch.load(fname)
         self.nnet.load_state_dict(checkpoint['state_dict'])
+        self.weights_changed()
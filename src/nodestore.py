@@ -0,0 +1,203 @@
+import numpy as np
+from collections import OrderedDict
+
+
+class Node():
+    """
+    Search statistics of one expanded state. Every array is indexed by the
+    position of an action in actions, which holds the legal actions only.
+    """
+
+    __slots__ = ('actions', 'P', 'N', 'W', 'visits', 'ended')
+
+    EPS = 1e-8
+
+    OVERHEAD = 480      # approximate bytes of the object and array headers
+
+    def __init__(self, actions, priors, ended=0):
+        self.actions = actions                          # legal action ids
+        self.P = priors                                 # prior of each legal action
+        self.N = np.zeros(len(actions), dtype=np.int64)  # edge visit counts
+        self.W = np.zeros(len(actions))                 # edge value sums
+        self.visits = 0                                 # total visits of the state
+        self.ended = ended                              # game.has_puzzle_ended for the state
+
+    @classmethod
+    def terminal(cls, ended):
+        """
+        A node for an ended puzzle, which has no actions to expand.
+        """
+        return cls(np.empty(0, dtype=np.int64), np.empty(0), ended)
+
+    def select(self, cpuct):
+        """
+        Returns the index of the legal action with the highest upper confidence bound.
+        """
+        Q = np.divide(self.W, self.N, out=np.zeros_like(self.W), where=self.N > 0)
+        u = Q + cpuct * self.P * np.sqrt(self.visits + self.EPS) / (1 + self.N)
+        return int(np.argmax(u))
+
+    def backup(self, i, v):
+        """
+        Adds the value v of a simulation through the ith legal action.
+        """
+        self.N[i] += 1
+        self.W[i] += v
+        self.visits += 1
+
+    def apply_virtual_loss(self, i, loss):
+        """
+        Counts a pending simulation through the ith legal action as a visit
+        with value -loss, steering concurrent descents to other actions.
+        """
+        self.N[i] += 1
+        self.W[i] -= loss
+        self.visits += 1
+
+    def revert_virtual_loss(self, i, loss):
+        self.N[i] -= 1
+        self.W[i] += loss
+        self.visits -= 1
+
+    def nbytes(self):
+        """
+        Approximate memory used by the node.
+        """
+        return self.OVERHEAD + self.actions.nbytes + self.P.nbytes + self.N.nbytes + self.W.nbytes
+
+    def counts(self, action_size):
+        """
+        Visit counts of every action in the full action space.
+        """
+        counts = np.zeros(action_size, dtype=np.int64)
+        counts[self.actions] = self.N
+        return counts
+
+
+class NodeStore():
+    """
+    Maps state keys to their expanded Node, counting lookup hits and misses.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.pinned = None      # key of the search root, never evicted
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, s):
+        return s in self.nodes
+
+    def get(self, s):
+        """
+        Returns the node of state s, or None if it was not expanded.
+        """
+        node = self.nodes.get(s)
+        if node is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return node
+
+    def add(self, s, node):
+        self.nodes[s] = node
+
+    def pin(self, s):
+        """
+        Protects the node of state s, the root of the current search, from eviction.
+        """
+        self.pinned = s
+
+    def stats(self):
+        return {'nodes': len(self.nodes), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class BoundedNodeStore(NodeStore):
+    """
+    A NodeStore holding at most max_nodes nodes and about max_bytes bytes of
+    node statistics, a limit of 0 being disabled. Once full it evicts either
+    the least recently visited nodes ('lru') or the nodes with the lowest
+    visit count ('visits'). An evicted state is expanded again when the
+    search reaches it. The pinned root and the node just added are never
+    evicted, so the store may stay above its limits when they alone exceed them.
+    """
+
+    POLICIES = ('lru', 'visits')
+
+    def __init__(self, max_nodes=0, max_bytes=0, policy='lru'):
+        super(BoundedNodeStore, self).__init__()
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown eviction policy {}".format(policy))
+        self.nodes = OrderedDict()
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.nbytes = 0
+
+    def get(self, s):
+        node = super(BoundedNodeStore, self).get(s)
+        if node is not None and self.policy == 'lru':
+            self.nodes.move_to_end(s)
+        return node
+
+    def add(self, s, node):
+        previous = self.nodes.pop(s, None)
+        if previous is not None:
+            self.nbytes -= previous.nbytes()
+        self.nodes[s] = node
+        self.nbytes += node.nbytes()
+
+        if self._full():
+            self._evict(s)
+
+    def stats(self):
+        stats = super(BoundedNodeStore, self).stats()
+        stats['bytes'] = self.nbytes
+        return stats
+
+    def _full(self):
+        return bool((self.max_nodes and len(self.nodes) > self.max_nodes) or
+                    (self.max_bytes and self.nbytes > self.max_bytes))
+
+    def _drop(self, s):
+        self.nbytes -= self.nodes.pop(s).nbytes()
+        self.evictions += 1
+
+    def _evict(self, added):
+        """
+        Evicts nodes until the store is within its limits again, never
+        evicting the node that was just added nor the pinned root.
+        """
+        kept = (added, self.pinned)
+        if self.policy == 'lru':
+            while self._full():
+                s = next((s for s in self.nodes if s not in kept), None)
+                if s is None:
+                    return
+                self._drop(s)
+            return
+
+        # a tenth of the store is evicted at once so that the visit counts are
+        # not scanned on every insertion
+        while self._full():
+            keys = [s for s in self.nodes if s not in kept]
+            if not keys:
+                return
+            visits = np.fromiter((self.nodes[s].visits for s in keys), dtype=np.int64, count=len(keys))
+            count = max(1, len(keys) // 10)
+            for i in np.argpartition(visits, count - 1)[:count]:
+                self._drop(keys[i])
+
+
+def make_node_store(args):
+    """
+    Returns the node store selected by the MCTS arguments.
+    """
+    if args.mctsMaxNodes or args.mctsMaxBytes:
+        return BoundedNodeStore(args.mctsMaxNodes, args.mctsMaxBytes, args.mctsEviction)
+    return NodeStore()
@@ -0,0 +1,144 @@
+import json
+import os
+import shutil
+import numpy as np
+from compactExamples import Example, examples_to_columns
+
+
+class Shard():
+    """
+    The examples of one iteration, stored as one .npy file per column of
+    compactExamples.examples_to_columns and memory-mapped on read.
+    """
+
+    COLUMNS = ('boards', 'pi_offsets', 'pi_index', 'pi_prob', 'vs')
+
+    def __init__(self, path):
+        self.path = path
+        for column in self.COLUMNS:
+            setattr(self, column, np.load(os.path.join(path, column + '.npy'), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.vs)
+
+    def __getitem__(self, i):
+        start, end = self.pi_offsets[i], self.pi_offsets[i + 1]
+        return Example(np.array(self.boards[i]), np.array(self.pi_index[start:end]),
+                       np.array(self.pi_prob[start:end]), self.vs[i])
+
+    @classmethod
+    def write(cls, path, examples):
+        """
+        Writes Examples as a new shard. The columns are written to a temporary
+        directory that is renamed into place, so a shard is never seen half written.
+        """
+        columns = examples_to_columns(examples)
+
+        temp = path + '.tmp'
+        if os.path.exists(temp):
+            shutil.rmtree(temp)
+        os.makedirs(temp)
+        for column, values in columns.items():
+            np.save(os.path.join(temp, column + '.npy'), values)
+        os.rename(temp, path)
+
+
+class ReplayView():
+    """
+    Read-only sequence of the Examples of several shards.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.ends = np.cumsum([len(shard) for shard in shards], dtype=np.int64)
+
+    def __len__(self):
+        return int(self.ends[-1]) if len(self.ends) else 0
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("replay index out of range")
+        shard = int(np.searchsorted(self.ends, i, side='right'))
+        start = self.ends[shard - 1] if shard > 0 else 0
+        return self.shards[shard][int(i - start)]
+
+
+class ReplayStore():
+    """
+    Append-only store of training examples holding one shard per self-play
+    iteration, listed in a small manifest. Shards are named and ordered by a
+    sequence number that only grows, also across resumed runs whose
+    iteration counter starts again at 1. Only the retention most recent
+    shards are kept; older ones are deleted when a new shard is appended.
+    A store starts empty unless resume is set, in which case it reopens the
+    manifest found in folder; the shards of an earlier run that are not in
+    the manifest are deleted on the first append.
+    """
+
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, folder, retention, resume=False):
+        self.folder = folder
+        self.retention = retention
+        self.manifest = {'shards': []}
+
+        path = os.path.join(folder, self.MANIFEST)
+        if resume and os.path.isfile(path):
+            with open(path) as f:
+                self.manifest = json.load(f)
+
+    def __len__(self):
+        return len(self.manifest['shards'])
+
+    @staticmethod
+    def _sequence(shard):
+        # manifests written before sequence numbers were ordered by iteration
+        return shard.get('sequence', shard['iteration'])
+
+    def append(self, iteration, examples):
+        """
+        Writes the examples of an iteration as a new shard, numbered after the
+        newest one, and drops the shards beyond the retention. A shard is
+        never overwritten.
+        """
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+        # shards left by an earlier run are no longer listed in the manifest
+        shards = self.manifest['shards']
+        listed = set(shard['name'] for shard in shards)
+        for entry in os.listdir(self.folder):
+            if entry.startswith('shard_') and entry not in listed:
+                shutil.rmtree(os.path.join(self.folder, entry), ignore_errors=True)
+
+        sequence = max([self._sequence(shard) + 1 for shard in shards] + [0])
+        name = 'shard_{:06d}'.format(sequence)
+        path = os.path.join(self.folder, name)
+        if os.path.exists(path):
+            raise FileExistsError("Replay shard {} already exists".format(path))
+        Shard.write(path, list(examples))
+
+        shards = shards + [{'name': name, 'sequence': sequence, 'iteration': iteration, 'count': len(examples)}]
+        shards.sort(key=self._sequence)
+        dropped, shards = shards[:-self.retention], shards[-self.retention:]
+        self.manifest['shards'] = shards
+        self._write_manifest()
+
+        for shard in dropped:
+            print("Dropping replay shard of iteration", shard['iteration'])
+            shutil.rmtree(os.path.join(self.folder, shard['name']), ignore_errors=True)
+
+    def examples(self):
+        """
+        Returns a memory-mapped view over the examples of every kept shard.
+        """
+        return ReplayView([Shard(os.path.join(self.folder, shard['name']))
+                           for shard in self.manifest['shards']])
+
+    def _write_manifest(self):
+        path = os.path.join(self.folder, self.MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(path + '.tmp', path)
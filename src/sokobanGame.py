@@ -1,6 +1,6 @@
 from sokobanLogic import Board
+from heuristic import HeuristicEngine
 import numpy as np
-from torch.nn import Sigmoid
 
 
 class Sokoban():
@@ -34,58 +34,139 @@ class Sokoban():
 
     def get_valid_moves(self, board):
         """
-        Returns the valid moves in the current game state.
+        Returns the valid moves in the current game state. A move is encoded
+        as the flat index x * height + y of the square the player steps onto.
         """
         valid_moves = [0] * self.get_action_size()
         legal_moves = board.get_moves()
+        playerX, playerY = board._find_player()
 
         if not legal_moves:
             valid_moves[-1] = 1
         else:
             for (x, y) in legal_moves:
-                valid_moves[self.width * x + y] = 1
+                valid_moves[self.height * (playerX + x) + playerY + y] = 1
         
         return np.array(valid_moves)
 
     def get_next_state(self, board, action):
         """
         Produces the next state derived from an action.
+        The board is changed in place.
         """
-        if action == (self.height * self.width):
+        move = self._action_to_move(board, action)
+        if move is None:
             return board
-        
-        move = (int(action / self.width), action % self.height)
+
         board.execute_move(move)
 
         return board
 
+    def push_action(self, board, action):
+        """
+        Applies an action to the board in place, so that pop_action can undo it.
+        """
+        board.push_move(self._action_to_move(board, action))
+
+    def pop_action(self, board):
+        """
+        Undoes the last action applied by push_action.
+        """
+        board.pop_move()
+
+    def _action_to_move(self, board, action):
+        """
+        Returns the board move of an action, None for the pass action.
+        """
+        if action == (self.height * self.width):
+            return None
+
+        x, y = divmod(action, self.height)
+        playerX, playerY = board._find_player()
+        return (x - playerX, y - playerY)
+
+    def push_actions(self, board, box, direction_id):
+        """
+        Returns the actions walking the player behind a box and pushing it in
+        a direction, or None when the player can not get behind it.
+        """
+        level = board.level
+        walk = board.walk_to(level.neighbours[box][(direction_id + 2) % 4])
+        if walk is None:
+            return None
+
+        actions = []
+        square = board.player
+        for step in walk + [direction_id]:
+            actions.append(self._move_action(level, square, step))
+            square = level.neighbours[square][step]
+        return actions
+
+    def _move_action(self, level, square, direction_id):
+        """
+        Returns the action moving the player from a square in a direction.
+        """
+        return level.neighbours[square][direction_id]
+
     def has_puzzle_ended(self, board):
         """
-        Returns a 1 if the puzzle has been solved and a 0 if it hasn't.
+        Returns a 1 if the puzzle has been solved, a -1 if it is deadlocked
+        and can no longer be solved and a 0 otherwise.
         """
         test = board.end_test()
 
         if test:
             return 1
+        if board.is_deadlocked():
+            return -1
         return 0
 
     def get_symmetries(self, board, pi):
         """
         Rotates the matrix.
         """
+        return [self.apply_symmetry(board.board, pi, symmetry) for symmetry in self.get_symmetry_ids()]
+
+    def get_symmetry_ids(self):
+        """
+        Returns the (rotations, flip) transforms that keep the board shape:
+        all 8 on square boards, but only the half turns with and without a
+        flip on the others, as a quarter turn would transpose the board.
+        """
+        rotations = range(1, 5) if self.height == self.width else (2, 4)
+        return [(i, j) for i in rotations for j in [True, False]]
+
+    def apply_symmetry(self, board, pi, symmetry):
+        """
+        Applies one (rotations, flip) transform to a board array and its policy.
+        """
         assert(len(pi) == self.height * self.width + 1)  # 1 for pass
-        pi_board = np.reshape(pi[:-1], (self.height, self.width))
-        l = []
-
-        for i in range(1, 5):
-            for j in [True, False]:
-                newB = np.rot90(board.board, i)
-                newPi = np.rot90(pi_board, i)
-                if j:
-                    newB = np.fliplr(newB)
-                    newPi = np.fliplr(newPi)
-                l += [(newB, list(newPi.ravel()) + [pi[-1]])]
-        return l
+        pi_board = np.reshape(pi[:-1], (self.width, self.height))
+        newB = self._transform(board, symmetry)
+        newPi = self._transform(pi_board, symmetry)
+        return newB, list(newPi.ravel()) + [pi[-1]]
+
+    def apply_symmetry_batch(self, boards, pis, symmetry):
+        """
+        Applies one (rotations, flip) transform to a (n, width, height) batch
+        of boards and its (n, action_size) policies.
+        """
+        pi_boards = pis[:, :-1].reshape(-1, self.width, self.height)
+        newB = self._transform(boards, symmetry, axes=(1, 2))
+        newPi = self._transform(pi_boards, symmetry, axes=(1, 2))
+        return newB, np.concatenate([newPi.reshape(len(pis), -1), pis[:, -1:]], axis=1)
+
+    @staticmethod
+    def _transform(array, symmetry, axes=(0, 1)):
+        """
+        Rotates an array i quarter turns over axes, then flips it along the
+        second axis if j, for the symmetry (i, j).
+        """
+        i, j = symmetry
+        array = np.rot90(array, i, axes=axes)
+        if j:
+            array = np.flip(array, axis=axes[1])
+        return array
 
     def string_representation(self, board):
         """
@@ -93,13 +174,168 @@ class Sokoban():
         """
         return str(board)
 
+    def hash_representation(self, board):
+        """
+        Returns the 64-bit Zobrist hash of the puzzle state.
+        """
+        return board.zobrist
+
     def get_score(self, board):
-        score = board.count_stars()
-        median_distance = board.median_distance()
-        normalized_distance = Sigmoid(median_distance)
-        score += int((1 - normalized_distance) * 100)  # 100 is an arbitrary multiplier to the score
-        
-        return score
+        """
+        Scores a board for the greedy player, higher is better: minus the
+        heuristic lower bound of the pushes left, deadlocks scoring lowest.
+        """
+        bound = HeuristicEngine.for_level(board.level).lower_bound(board)
+        if bound is None or board.is_deadlocked():
+            return -HeuristicEngine.INFINITE
+
+        return -bound
+
+class SokobanDirectional(Sokoban):
+    """
+    Sokoban with a compact action head: an action is the index of a direction
+    in sokobanLogic.Board._directions, followed by the pass action.
+    """
+
+    def get_action_size(self):
+        """
+        Returns the four directions plus the pass action.
+        """
+        return len(Board._directions) + 1
+
+    def get_valid_moves(self, board):
+        """
+        Returns the valid directions in the current game state.
+        """
+        valid_moves = np.zeros(self.get_action_size(), dtype=int)
+        legal_moves = board.get_moves()
+
+        if not legal_moves:
+            valid_moves[-1] = 1
+        else:
+            for move in legal_moves:
+                valid_moves[Board._direction_ids[move]] = 1
+
+        return valid_moves
+
+    def _action_to_move(self, board, action):
+        """
+        Returns the board move of an action, None for the pass action.
+        """
+        if action == len(Board._directions):
+            return None
+
+        return Board._directions[action]
+
+    def _move_action(self, level, square, direction_id):
+        return direction_id
+
+    def apply_symmetry(self, board, pi, symmetry):
+        """
+        Applies one (rotations, flip) transform to a board array and permutes
+        the directions of its policy accordingly.
+        """
+        pi = np.asarray(pi)
+        newPi = pi.copy()
+        newPi[self._direction_permutation(symmetry)] = pi[:-1]
+        return self._transform(board, symmetry), list(newPi)
+
+    def apply_symmetry_batch(self, boards, pis, symmetry):
+        newPis = pis.copy()
+        newPis[:, self._direction_permutation(symmetry)] = pis[:, :-1]
+        return self._transform(boards, symmetry, axes=(1, 2)), newPis
+
+    def _direction_permutation(self, symmetry):
+        """
+        Returns, for every direction id, the id of the direction it becomes
+        under a symmetry, found by transforming a marker next to the centre of
+        a 3x3 grid.
+        """
+        permutation = []
+        for dx, dy in Board._directions:
+            marker = np.zeros((3, 3))
+            marker[1 + dx][1 + dy] = 1
+            x, y = np.argwhere(self._transform(marker, symmetry))[0]
+            permutation.append(Board._direction_ids[(int(x) - 1, int(y) - 1)])
+        return permutation
+
+
+class SokobanPush(Sokoban):
+    """
+    Sokoban played at the level of box pushes. An action is a (box square,
+    direction) pair encoded as 4 * square + direction id, where square is the
+    flat board index x * height + y; the player walks to the box on its own.
+    Boards are kept with the player on the canonical square of its reachable
+    region, so states that only differ by a walk are the same state.
+    """
+
+    def get_initial_board(self):
+        """
+        Returns an initial state of a board, with a normalized player.
+        """
+        board = super(SokobanPush, self).get_initial_board()
+        board.normalize_player()
+
+        return board
+
+    def get_action_size(self):
+        """
+        Returns the number of (square, direction) pushes plus the pass action.
+        """
+        return self.height * self.width * 4 + 1
+
+    def get_valid_moves(self, board):
+        """
+        Returns the valid pushes in the current game state.
+        """
+        valid_moves = np.zeros(self.get_action_size(), dtype=int)
+        legal_pushes = board.get_pushes()
+
+        if not legal_pushes:
+            valid_moves[-1] = 1
+        else:
+            for box, direction_id in legal_pushes:
+                valid_moves[4 * box + direction_id] = 1
+
+        return valid_moves
+
+    def get_next_state(self, board, action):
+        """
+        Produces the next state derived from a push.
+        The board is changed in place.
+        """
+        if action != self.get_action_size() - 1:
+            board.push_box(*divmod(action, 4))
+
+        return board
+
+    def push_action(self, board, action):
+        """
+        Applies a push to the board in place, so that pop_action can undo it.
+        """
+        if action == self.get_action_size() - 1:
+            board.push_move(None)
+        else:
+            board.push_box(*divmod(action, 4))
+
+    def push_actions(self, board, box, direction_id):
+        """
+        Returns the single action of a push.
+        """
+        return [4 * box + direction_id]
+
+    def get_symmetry_ids(self):
+        """
+        Push policies are not transformed, only the identity is used.
+        """
+        return [(0, False)]
+
+    def apply_symmetry(self, board, pi, symmetry):
+        return board, pi
+
+    def apply_symmetry_batch(self, boards, pis, symmetry):
+        return boards, pis
+
 
 def display(board):
     print(board)
@@ -1,10 +1,142 @@
 import numpy as np
+import random
+from evalcache import EvaluationCache
+
+
+class Level():
+    """
+    Static part of a sokoban level: walls, goals and the starting position.
+    A level is parsed once per level text and shared by every Board built from it.
+    Squares are addressed by the flat index x * height + y, the C-order ravel of
+    the (width, height) grid used by Board.board.
+    """
+
+    _cache = {}
+
+    _zobrist_seed = 0x5eed
+
+    REGION_CACHE_SIZE = 20000   # reachable regions cached per level, a few hundred bytes each
+
+    def __init__(self, text):
+        """
+        text is the textual representation of a whole sokoban level.
+        """
+        characters = Board._characters
+        lines = text.split("\n")
+        self.width = max(len(line) for line in lines)
+        self.height = len(lines)
+        self.size = self.width * self.height
+
+        walls = np.zeros((self.width, self.height), dtype=bool)
+        goals = np.zeros((self.width, self.height), dtype=bool)
+        boxes = np.zeros((self.width, self.height), dtype=np.uint8)
+        player = None
+
+        for y, line in enumerate(lines):
+            for x, character in enumerate(line):
+                code = characters[character]
+                if code == characters['#']:
+                    walls[x][y] = True
+                if code in (characters['.'], characters['*'], characters['+']):
+                    goals[x][y] = True
+                if code in (characters['$'], characters['*']):
+                    boxes[x][y] = 1
+                if code in (characters['@'], characters['+']):
+                    player = x * self.height + y
+
+        self.walls = walls.ravel()
+        self.goals = goals.ravel()
+        self.goals_mask = self.goals.astype(np.uint8)
+        self.goal_flags = tuple(int(goal) for goal in self.goals)    # fast scalar lookups
+        self.coords = np.stack(np.divmod(np.arange(self.size), self.height), axis=1)   # x, y of every square
+        self.free_mask = (~self.goals).astype(np.uint8)
+        self.initial_boxes = boxes.ravel()
+        self.initial_player = player
+
+        # character codes of the squares without player or boxes on them
+        self.base = np.full(self.size, characters[' '], dtype=np.uint8)
+        self.base[self.walls] = characters['#']
+        self.base[self.goals] = characters['.']
+        self.box_codes = np.where(self.goals, characters['*'], characters['$']).astype(np.uint8)
+        self.player_codes = np.where(self.goals, characters['+'], characters['@']).astype(np.uint8)
+
+        # 64-bit Zobrist keys for the player and box on every square
+        rng = random.Random(self._zobrist_seed)
+        self.player_keys = [rng.getrandbits(64) for _ in range(self.size)]
+        self.box_keys = [rng.getrandbits(64) for _ in range(self.size)]
+        self.initial_hash = self.state_hash(player, self.initial_boxes)
+
+        # neighbours[i][d] is the square reached from i in direction d, or -1 when blocked
+        self.neighbours = []
+        for index in range(self.size):
+            x, y = divmod(index, self.height)
+            row = []
+            for dx, dy in Board._directions:
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < self.width and 0 <= ny < self.height and not walls[nx][ny]:
+                    row.append(nx * self.height + ny)
+                else:
+                    row.append(-1)
+            self.neighbours.append(tuple(row))
+        self.neighbour_table = np.array(self.neighbours, dtype=np.int64)
+
+        self.dead = self._find_dead_squares()
+        self.dead_mask = self.dead.astype(np.uint8)
+        self.dead_flags = tuple(int(dead) for dead in self.dead)    # fast scalar lookups
+
+        # state hash -> (region mask, canonical square) of the player, shared by the boards of the level
+        self.regions = EvaluationCache(self.REGION_CACHE_SIZE)
+
+    def state_hash(self, player, boxes):
+        """
+        Zobrist hash of a player square and a flat box array, computed from scratch.
+        """
+        key = self.player_keys[player]
+        for index in np.flatnonzero(boxes):
+            key ^= self.box_keys[index]
+        return key
+
+    def _find_dead_squares(self):
+        """
+        Finds the squares from which a box can never be pushed onto a goal.
+        Boxes are pulled backwards from every goal: a box on square s can be
+        pulled to its neighbour n when the player has room to stand beyond n.
+        Every floor square not reached this way is dead.
+        """
+        live = self.goals.copy()
+        frontier = list(np.flatnonzero(self.goals))
+
+        while frontier:
+            square = frontier.pop()
+            for direction_id, neighbour in enumerate(self.neighbours[square]):
+                if neighbour < 0 or live[neighbour]:
+                    continue
+                if self.neighbours[neighbour][direction_id] >= 0:
+                    live[neighbour] = True
+                    frontier.append(neighbour)
+
+        return ~live & ~self.walls
+
+    @classmethod
+    def from_text(cls, text):
+        """
+        Returns the shared Level for a level text, parsing it on first use.
+        """
+        level = cls._cache.get(text)
+        if level is None:
+            level = cls._cache[text] = cls(text)
+        return level
 
 
 class Board():
     """
     Characters described in https://www.sokoban-online.de/sokoban/levell-format/
     Puzzles should come from http://www.abelmartin.com/rj/sokoban_colecciones.html
+
+    The static walls and goals live in a shared Level. The dynamic state is the
+    player square plus a uint8 box array, both indexed by flat square index and
+    updated incrementally by execute_move together with a Zobrist hash and the
+    counts of boxes on (stars) and off (loose) goals.
     """
 
     _characters = {
@@ -19,187 +151,413 @@ class Board():
 
     _num_to_char = {v: k for k, v in _characters.items()}
 
+    _char_table = np.array([character for _, character in sorted(_num_to_char.items())])
+
     _directions = [(0, -1), (1, 0), (0, 1), (-1, 0)]  # Top, right, down, left
 
+    _direction_ids = {direction: i for i, direction in enumerate(_directions)}
+
     def __init__(self, text):
         """
         text is the textual representation of a whole sokoban level.
         """
-        self._lines = text.split("\n")
-        self.width = max(list(map(lambda x: len(self._lines[x]), range(len(self._lines)))))
-        self.height = len(self._lines)
-
-        self.board = np.empty((self.width, self.height), dtype=int)
-        for i in range(len(self._lines)):
-            line = self._lines[i]
-            for j, character in enumerate(line):
-                self.board[j][i] = self._characters[character]
+        self.level = Level.from_text(text)
+        self.width = self.level.width
+        self.height = self.level.height
+        self.player = self.level.initial_player
+        self.boxes = self.level.initial_boxes.copy()
+        self.zobrist = self.level.initial_hash
+        self.move_stack = []
+        self._count_boxes()
+
+    def copy(self):
+        """
+        Returns an independent board sharing the same static level.
+        """
+        board = Board.__new__(Board)
+        board.level = self.level
+        board.width = self.width
+        board.height = self.height
+        board.player = self.player
+        board.boxes = self.boxes.copy()
+        board.zobrist = self.zobrist
+        board.move_stack = []
+        board.stars = self.stars
+        board.loose = self.loose
+        return board
+
+    def set_state(self, player, boxes):
+        """
+        Replaces the dynamic state by a player square and a flat box array,
+        recomputing the hash and the box counts.
+        """
+        self.player = int(player)
+        self.boxes = np.asarray(boxes, dtype=np.uint8).copy()
+        self.zobrist = self.level.state_hash(self.player, self.boxes)
+        self.move_stack = []
+        self._count_boxes()
 
+    def shift_state(self, player, sources, targets):
+        """
+        Replaces the dynamic state by a nearby one: the boxes of sources move
+        to targets and the player to a square, updating the hash and the box
+        counts incrementally instead of recomputing them like set_state.
+        """
+        for source, target in zip(sources, targets):
+            self._move_box(source, target)
+        self.zobrist ^= self.level.player_keys[self.player] ^ self.level.player_keys[player]
+        self.player = player
+        self.move_stack = []
 
-    # def __getitem__(self, index):
-    #     return self.board[index]
+    def _count_boxes(self):
+        self.stars = int(np.count_nonzero(self.boxes & self.level.goals_mask))
+        self.loose = int(np.count_nonzero(self.boxes)) - self.stars
 
-    # def __setitem__(self, index, value):
-    #     self.board[index] = value
+    def _move_box(self, source, target):
+        """
+        Moves a box between two squares, updating the hash and the box counts.
+        """
+        level = self.level
+        self.boxes[source] = 0
+        self.boxes[target] = 1
+        self.zobrist ^= level.box_keys[source] ^ level.box_keys[target]
+        delta = level.goal_flags[target] - level.goal_flags[source]
+        self.stars += delta
+        self.loose -= delta
+
+    @property
+    def board(self):
+        """
+        The (width, height) grid of character codes for the current state.
+        """
+        level = self.level
+        grid = np.where(self.boxes, level.box_codes, level.base)
+        grid[self.player] = level.player_codes[self.player]
+        return grid.reshape(self.width, self.height)
 
     def __str__(self):
         """
         Returns a string representation of the puzzle state.
         """
-        string = ""
-        
-        for x in range(self.width):
-            line_str = ""
-            for y in range(self.height):
-                line_str += self._num_to_char[self.board[x][y]]
-            line_str += "\n"
-            string += line_str
-        
-        return string
+        return "".join("".join(line) + "\n" for line in self._char_table[self.board])
 
     def end_test(self):
         """
-        Evaluates whether the current state is an end state.
+        Evaluates whether the current state is an end state: no box is off a goal.
+        """
+        return self.loose == 0
+
+    def is_deadlocked(self):
+        """
+        Evaluates whether the puzzle can no longer be solved: a box sits on a
+        dead square, inside a 2x2 block of walls and boxes or is frozen, and
+        is not on a goal.
+        """
+        level = self.level
+        if np.any(self.boxes & level.dead_mask):
+            return True
+
+        for box in np.flatnonzero(self.boxes & level.free_mask):
+            if self._in_blocked_square(box) or self._is_frozen(box, frozenset()):
+                return True
+
+        return False
+
+    def is_push_deadlocked(self, square):
+        """
+        The deadlock tests of is_deadlocked restricted to the boxes that a push
+        onto square may have blocked: the pushed box and its neighbours, e.g.
+        after a push of get_pushes, which never ends on a dead square. Only
+        a 2x2 block whose loose box is diagonal to square is missed.
+        """
+        goal_flags = self.level.goal_flags
+        for box in (square,) + self.level.neighbours[square]:
+            if box < 0 or not self.boxes[box] or goal_flags[box]:
+                continue
+            if self._in_blocked_square(box) or self._is_frozen(box, frozenset()):
+                return True
+        return False
+
+    def _in_blocked_square(self, box):
+        """
+        Whether a box is part of a 2x2 block made only of walls and boxes.
+        """
+        neighbours = self.level.neighbours
+
+        def occupied(square):
+            return square < 0 or self.boxes[square]
+
+        for first, second in ((0, 1), (1, 2), (2, 3), (3, 0)):
+            side = neighbours[box][first]
+            other = neighbours[box][second]
+            if not (occupied(side) and occupied(other)):
+                continue
+            if side >= 0:
+                diagonal = neighbours[side][second]
+            elif other >= 0:
+                diagonal = neighbours[other][first]
+            else:
+                # walls on both sides, a corner
+                return True
+            if occupied(diagonal):
+                return True
+
+        return False
+
+    def _is_frozen(self, box, checked):
+        """
+        Whether the box can never be moved again along either axis. Boxes in
+        checked are treated as walls, which breaks cycles between boxes.
         """
-        for x in range(self.width):
-            for y in range(self.height):
-                if self._num_to_char[self.board[x][y]] == "$":
-                    return False
-        return True
+        checked = checked | {box}
+        return self._is_blocked(box, 1, 3, checked) and self._is_blocked(box, 0, 2, checked)
+
+    def _is_blocked(self, box, direction_a, direction_b, checked):
+        """
+        Whether the box can not be pushed along the axis of the two directions.
+        """
+        neighbours = self.level.neighbours
+        dead = self.level.dead
+        a, b = neighbours[box][direction_a], neighbours[box][direction_b]
+
+        if a < 0 or b < 0 or a in checked or b in checked:
+            return True
+        if dead[a] and dead[b]:
+            return True
+        return bool((self.boxes[a] and self._is_frozen(a, checked)) or
+                    (self.boxes[b] and self._is_frozen(b, checked)))
 
     def get_moves(self):
         """
-        Gets all the legal moves.
+        Gets all the legal moves. Pushing a box onto a dead square is not legal.
         """
-        playerX, playerY = self._find_player()
+        neighbours = self.level.neighbours
+        dead = self.level.dead
+        boxes = self.boxes
         moves = set()
 
-        for direction in self._directions:
-            target_pos_x, target_pos_y = playerX + direction[0], playerY + direction[1]
-            beyond_pos_x, beyond_pos_y = self._get_beyond_coords(self._directions.index(direction))
-            target_character = self.board[target_pos_x][target_pos_y]
-            beyond_character = self.board[beyond_pos_x][beyond_pos_y]
-
-            if target_character in [self._characters['$'], self._characters['*']]:
-                if beyond_character != self._characters['#']:
-                    moves.add(direction)
-            if target_character != self._characters["#"]:
-                moves.add(direction)
+        for direction_id, target in enumerate(neighbours[self.player]):
+            if target < 0:
+                continue
+            if boxes[target]:
+                beyond = neighbours[target][direction_id]
+                if beyond < 0 or boxes[beyond] or dead[beyond]:
+                    continue
+            moves.add(self._directions[direction_id])
 
         return moves
 
     def execute_move(self, move):
         """
-        Changes the board by executing a move.
+        Changes the board by executing a legal move.
         """
-        playerX, playerY = self._find_player()
-        player_character = self.board[playerX][playerY]
-        target_pos_x, target_pos_y = playerX + move[0], playerY + move[1]
-        target_character = self.board[target_pos_x][target_pos_y]
-        direction_id = self._directions.index(move)
-        beyond_pos_x, beyond_pos_y = self._get_beyond_coords(direction_id)
-        beyond_character = self.board[beyond_pos_x][beyond_pos_y]
-
-        # Is it a move where you don't push a box
-        if target_character != self._characters["$"] and target_character != self._characters["*"]:
-            # The new location
-            if target_character == self._characters["."]:
-                self.board[target_pos_x][target_pos_y] = self._characters["+"]
-            else:
-                self.board[target_pos_x][target_pos_y] = self._characters["@"]
+        direction_id = self._direction_ids[move]
+        level = self.level
+        target = level.neighbours[self.player][direction_id]
 
-            # old location
-            if player_character == self._characters["+"]:
-                self.board[playerX][playerY] = self._characters["."]
-            else:
-                self.board[playerX][playerY] = self._characters[" "]
+        # push move
+        if self.boxes[target]:
+            self._move_box(target, level.neighbours[target][direction_id])
 
-        # or is it a push move
-        else:
-            if beyond_character == self._characters["."]:
-                self.board[beyond_pos_x][beyond_pos_y] = self._characters["*"]
-            else:
-                self.board[beyond_pos_x][beyond_pos_y] = self._characters["$"]
+        self.zobrist ^= level.player_keys[self.player] ^ level.player_keys[target]
+        self.player = target
 
-            if target_character == self._characters["*"]:
-                self.board[target_pos_x][target_pos_y] = self._characters["+"]
-            else:
-                self.board[target_pos_x][target_pos_y] = self._characters["@"]
+    def push_move(self, move):
+        """
+        Executes a legal move and records it on the move stack so that pop_move
+        can undo it. A move of None is a pass and leaves the board unchanged.
+        The undo record is a single int: previous player square, the square
+        the player stepped onto, direction and whether a box was pushed.
+        """
+        if move is None:
+            self.move_stack.append(-1)
+            return
 
-            if player_character == self._characters["+"]:
-                self.board[playerX][playerY] = self._characters["."]
-            else:
-                self.board[playerX][playerY] = self._characters[" "]
+        direction_id = self._direction_ids[move]
+        target = self.level.neighbours[self.player][direction_id]
+        pushed = 1 if self.boxes[target] else 0
+        self.move_stack.append(self._undo_record(target, direction_id, pushed))
+        self.execute_move(move)
+
+    def pop_move(self):
+        """
+        Undoes the last move recorded by push_move or push_box.
+        """
+        record = self.move_stack.pop()
+        if record < 0:
+            return
+
+        level = self.level
+        player, target = divmod(record >> 3, level.size)
+        direction_id, pushed = (record >> 1) & 3, record & 1
+
+        if pushed:
+            self._move_box(level.neighbours[target][direction_id], target)
+
+        self.zobrist ^= level.player_keys[self.player] ^ level.player_keys[player]
+        self.player = player
+
+    def _undo_record(self, target, direction_id, pushed):
+        return ((self.player * self.level.size + target) << 3) | (direction_id << 1) | pushed
+
+    def reachable(self):
+        """
+        Returns the squares the player can walk to without pushing a box, as
+        a bytes mask over the squares, and the smallest of them, the canonical
+        player square of the region. Regions are cached per level by state
+        hash, so that states revisited by a search skip the flood fill.
+        """
+        region = self.level.regions.get(self.zobrist)
+        if region is not None:
+            return region
+
+        neighbours = self.level.neighbours
+        boxes = self.boxes.tobytes()    # indexing bytes is faster than the array
+        mask = bytearray(self.level.size)
+        mask[self.player] = 1
+        frontier = [self.player]
+        canonical = self.player
+
+        while frontier:
+            square = frontier.pop()
+            for neighbour in neighbours[square]:
+                if neighbour >= 0 and not boxes[neighbour] and not mask[neighbour]:
+                    mask[neighbour] = 1
+                    frontier.append(neighbour)
+                    if neighbour < canonical:
+                        canonical = neighbour
+
+        region = (bytes(mask), canonical)
+        self.level.regions.put(self.zobrist, region)
+        return region
+
+    def walk_to(self, square):
+        """
+        Returns the direction ids of a shortest walk of the player to a
+        square without pushing a box, or None when it can not be reached.
+        """
+        neighbours = self.level.neighbours
+        boxes = self.boxes
+        parents = {self.player: None}
+        frontier = [self.player]
+
+        while frontier and square not in parents:
+            following = []
+            for current in frontier:
+                for direction_id, neighbour in enumerate(neighbours[current]):
+                    if neighbour >= 0 and neighbour not in parents and not boxes[neighbour]:
+                        parents[neighbour] = (current, direction_id)
+                        following.append(neighbour)
+            frontier = following
+
+        if square not in parents:
+            return None
+        walk = []
+        while parents[square] is not None:
+            square, direction_id = parents[square]
+            walk.append(direction_id)
+        return walk[::-1]
+
+    def normalize_player(self):
+        """
+        Moves the player to the canonical square of its reachable region, so
+        that every state which only differs by a walk shares one hash.
+        """
+        region = self.reachable()
+        canonical = region[1]
+        if canonical != self.player:
+            self.zobrist ^= self.level.player_keys[self.player] ^ self.level.player_keys[canonical]
+            self.player = canonical
+            self.level.regions.put(self.zobrist, region)
+
+    def get_pushes(self):
+        """
+        Gets all the legal box pushes as (box square, direction id) pairs: the
+        player can walk behind the box and the square beyond it is free and
+        not dead.
+        """
+        neighbours = self.level.neighbours
+        dead = self.level.dead_flags
+        boxes = self.boxes.tobytes()
+        region, _ = self.reachable()
+        pushes = []
+
+        for box in np.flatnonzero(self.boxes).tolist():
+            for direction_id, beyond in enumerate(neighbours[box]):
+                if beyond < 0 or boxes[beyond] or dead[beyond]:
+                    continue
+                behind = neighbours[box][(direction_id + 2) % 4]
+                if behind >= 0 and region[behind]:
+                    pushes.append((box, direction_id))
+
+        return pushes
+
+    def push_box(self, box, direction_id, normalize=True):
+        """
+        Walks the player behind a box and pushes it one square, recording the
+        push on the move stack for pop_move. Unless normalize is False, the
+        player is then normalized to the canonical square of its new region.
+        """
+        level = self.level
+        beyond = level.neighbours[box][direction_id]
+        self.move_stack.append(self._undo_record(box, direction_id, 1))
+
+        self._move_box(box, beyond)
+        self.zobrist ^= level.player_keys[self.player] ^ level.player_keys[box]
+        self.player = box
+        if normalize:
+            self.normalize_player()
 
     def count_stars(self):
         """
         Verifies the number of boxes in the goal.
         """
-        number = 0
-        
-        for x in range(self.width):
-            for y in range(len(self.board[x])):
-                if self.board[x][y] == self._characters["*"]:
-                    number += 1
+        return self.stars
 
-        return number
-    
     def median_distance(self):
         """
-        Returns the median distance of all boxes to all goals using manhattan distance
-        """
-
-        def manhattan_distance(coord1, coord2):
-            """
-            Manhattan distance between two coordinates.
-            """
-            return abs(coord1[0] - coord2[0]) + abs(coord1[1] - coord2[1])
-
-        boxes = self._find_unattended_boxes()
-        goals = self._find_unattended_goals()
-        distances = []
-        
-        for box in boxes:
-            for goal in goals:
-                distances.append(manhattan_distance(box, goal))
-        
-        return int(sum(distances) / len(distances)) if distances else 0
-        
-    def _find_unattended_boxes(self):
-        """
-        Finds the positions of the unattended(goal-less) boxes.
+        Returns the mean manhattan distance of all unattended boxes to all
+        unattended goals, from a broadcast distance matrix.
         """
-        positions = []
+        boxes = self._unattended_box_coords()
+        goals = self._unattended_goal_coords()
+        if not len(boxes) or not len(goals):
+            return 0
 
-        for x in range(self.width):
-            for y in range(self.height):
-                if self.board[x][y] == self._characters["$"]:
-                    positions.append((x,y))
+        distances = np.abs(boxes[:, None, :] - goals[None, :, :]).sum(axis=2)
+        return int(distances.sum() // distances.size)
 
-        return positions
+    def _unattended_box_coords(self):
+        """
+        (n, 2) array of the x, y positions of the boxes off goals.
+        """
+        return self.level.coords[np.flatnonzero(self.boxes & self.level.free_mask)]
 
-    def _find_unattended_goals(self):
+    def _unattended_goal_coords(self):
         """
-        Finds the position of all goals without a box.
+        (n, 2) array of the x, y positions of the goals without a box or the player on them.
         """
-        positions = []
+        free = self.level.goals & (self.boxes == 0)
+        free[self.player] = False
+        return self.level.coords[np.flatnonzero(free)]
 
-        for x in range(self.width):
-            for y in range(self.height):
-                if self.board[x][y] == self._characters["."]:
-                    positions.append((x,y))
+    def _find_unattended_boxes(self):
+        """
+        Finds the positions of the unattended(goal-less) boxes.
+        """
+        return [tuple(coords) for coords in self._unattended_box_coords().tolist()]
 
-        return positions
+    def _find_unattended_goals(self):
+        """
+        Finds the position of all goals without a box or the player on them.
+        """
+        return [tuple(coords) for coords in self._unattended_goal_coords().tolist()]
 
     def _find_player(self):
         """
         Finds the position x,y of the player.
         """
-        for x in range(self.width):
-            for y in range(self.height):
-                if self.board[x][y] == self._characters["@"] or self.board[x][y] == self._characters["+"]:
-                    return (x, y)
-        return None
+        return divmod(self.player, self.height)
 
     def _get_beyond_coords(self, direction_id):
         """
@@ -207,15 +565,5 @@ class Board():
         """
         move = self._directions[direction_id]
         playerX, playerY = self._find_player()
-        target_pos_x, target_pos_y = playerX + move[0], playerY + move[1]
-
-        if direction_id == 0:  # top
-            beyond_pos_x, beyond_pos_y = target_pos_x, target_pos_y - 1
-        elif direction_id == 1:  # right
-            beyond_pos_x, beyond_pos_y = target_pos_x + 1, target_pos_y
-        elif direction_id == 2:  # down
-            beyond_pos_x, beyond_pos_y = target_pos_x, target_pos_y + 1
-        else:  # left
-            beyond_pos_x, beyond_pos_y = target_pos_x - 1, target_pos_y
-
-        return beyond_pos_x, beyond_pos_y
+
+        return playerX + 2 * move[0], playerY + 2 * move[1]
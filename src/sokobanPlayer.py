@@ -3,15 +3,16 @@ class SokobanPlayer():
         self.game = game
 
     def play(self, board):
-        valids = board.get_valid_moves()
+        valids = self.game.get_valid_moves(board)
         candidates = []
 
         for action in range(self.game.get_action_size()):
             if valids[action] == 0:
                 continue
 
-            next_state = self.game.get_next_state(board, action)
-            score = self.game.get_score(next_state)
+            self.game.push_action(board, action)
+            score = self.game.get_score(board)
+            self.game.pop_action(board)
             candidates.append((-score, action))
         candidates.sort()
         
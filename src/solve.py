@@ -0,0 +1,49 @@
+from main import get_parser, make_game
+from nnwrapper import NNetWrapper as nn
+from mcts import MCTS
+import numpy as np
+import time
+
+
+def solve(game, mcts, max_moves=1000, verbose=False):
+    """
+    Plays one puzzle with the MCTS policy, starting its time budget first.
+    Returns the result of game.has_puzzle_ended and the (action, simulations,
+    milliseconds) of every move.
+    """
+    board = game.get_initial_board()
+    mcts.start_puzzle()
+    moves = []
+
+    while game.has_puzzle_ended(board) == 0 and len(moves) < max_moves:
+        start = time.time()
+        action = int(np.argmax(mcts.getActionProb(board, temp=0)))
+        moves.append((action, mcts.last_simulations, (time.time() - start) * 1000.))
+        if verbose:
+            print("Move {} action {} sims {} time {:.1f}ms".format(len(moves), *moves[-1]))
+        board = game.get_next_state(board, action)
+
+    return game.has_puzzle_ended(board), moves
+
+
+if __name__ == "__main__":
+    parser = get_parser("Solve a Sokoban puzzle with a time budgeted MCTS")
+    parser.add_argument('-maxmoves', '--max_moves', dest='maxMoves', type=int, default=1000,
+                        help="Number of moves before the puzzle is given up")
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False,
+                        help="Print every move")
+    args = parser.parse_args()
+
+    g = make_game(args)
+    nnet = nn(g, args)
+    if args.load_model:
+        nnet.load_checkpoint(args.load_folder_file)
+
+    start = time.time()
+    result, moves = solve(g, MCTS(g, nnet, args), args.maxMoves, args.verbose)
+    sims = [m[1] for m in moves]
+
+    print("Result", {1: "solved", -1: "deadlocked", 0: "unsolved"}[result], "in", len(moves), "moves",
+          "and {:.1f}s".format(time.time() - start))
+    if moves:
+        print("Simulations per move: mean {:.1f} min {} max {}".format(np.mean(sims), min(sims), max(sims)))
@@ -0,0 +1,275 @@
+import argparse
+import glob
+import heapq
+import os
+import re
+import time
+from collections import namedtuple
+import numpy as np
+from compactExamples import compress_example
+from heuristic import HeuristicEngine
+from sokobanLogic import Board
+
+
+# Outcome of one solve: status is 'solved', 'unsolvable', 'node_limit' or
+# 'time_limit', and solution the (box square, direction id) pushes found.
+SolverReport = namedtuple('SolverReport', ['algorithm', 'status', 'solution', 'nodes', 'seconds'])
+
+
+class _LimitReached(Exception):
+    pass
+
+
+def _squares(bits):
+    """
+    Squares of the set bits of a packed box set, in increasing order.
+    """
+    squares = []
+    while bits:
+        low = bits & -bits
+        squares.append(low.bit_length() - 1)
+        bits ^= low
+    return squares
+
+
+class PushSolver():
+    """
+    Classical solver of a level on pushes: A* or IDA* over boards with the
+    player normalized to its reachable region, guided by the admissible
+    matching lower bound of heuristic.HeuristicEngine, so that the solutions
+    have the fewest pushes. States are keyed by their Zobrist hash in a
+    transposition table. Pushes onto dead squares are never generated, and
+    the boards a push deadlocks are pruned before their bound is computed,
+    the bound itself being repaired from the matching of the board pushed.
+    A search stops after max_nodes expanded states or max_seconds, a limit
+    of 0 being disabled. A weight above 1 multiplies the lower bound in
+    f = g + weight * h: the search is greedier and solves more levels within
+    the limits, with solutions at most weight times longer than optimal.
+    """
+
+    ALGORITHMS = ('astar', 'idastar')
+
+    def __init__(self, text, max_nodes=1000000, max_seconds=0, weight=1.):
+        self.text = text
+        self.max_nodes = max_nodes
+        self.max_seconds = max_seconds
+        self.weight = weight
+
+    def initial_board(self):
+        board = Board(self.text)
+        board.normalize_player()
+        return board
+
+    def solve(self, algorithm='astar'):
+        """
+        Returns the SolverReport of a search from the initial board.
+        """
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError("Unknown solver algorithm {}".format(algorithm))
+
+        board = self.initial_board()
+        self.engine = HeuristicEngine.for_level(board.level)
+        self.nodes = 0
+        self.start = time.time()
+
+        try:
+            solution = self._astar(board) if algorithm == 'astar' else self._idastar(board)
+            status = 'solved' if solution is not None else 'unsolvable'
+        except _LimitReached as limit:
+            solution, status = None, str(limit)
+
+        return SolverReport(algorithm, status, solution, self.nodes, time.time() - self.start)
+
+    def _expand(self):
+        """
+        Counts an expanded state and enforces the limits.
+        """
+        self.nodes += 1
+        if self.max_nodes and self.nodes > self.max_nodes:
+            raise _LimitReached('node_limit')
+        if self.max_seconds and self.nodes % 256 == 0 and time.time() - self.start > self.max_seconds:
+            raise _LimitReached('time_limit')
+
+    def _children(self, board):
+        """
+        Yields the (push, lower bound) of every push of the board that does
+        not lead to a deadlock, the board being pushed while the caller
+        handles the child and restored afterwards. The deadlock test around
+        the pushed box comes first, then the bound, repaired from the
+        matching of the board, and the player is normalized last.
+        """
+        neighbours = board.level.neighbours
+        self.engine.lower_bound(board)
+        parent = self.engine.last
+
+        for box, direction_id in board.get_pushes():
+            board.push_box(box, direction_id, normalize=False)
+            if not board.is_push_deadlocked(neighbours[box][direction_id]):
+                bound = self.engine.lower_bound(board, parent)
+                if bound is not None:
+                    board.normalize_player()
+                    yield (box, direction_id), bound
+            board.pop_move()
+
+    def _astar(self, board):
+        """
+        A* with a closed set: the lower bound is consistent, as a push moves
+        one box by one square, so a state is expanded once with its best g.
+        The transposition table holds the best g, parent and push of every
+        generated state, with the state itself as its player square and its
+        boxes packed in an int; the heap only holds (f, -g, key) entries,
+        stale once a better g is found. Popped states are restored on the
+        board by moving the boxes that differ from the current state.
+        """
+        bound = self.engine.lower_bound(board)
+        if bound is None:
+            return None
+
+        neighbours = board.level.neighbours
+        bits = sum(1 << int(box) for box in np.flatnonzero(board.boxes))
+        table = {board.zobrist: (0, None, None, board.player, bits)}   # key -> g, parent, push, player, boxes
+        closed = set()
+        frontier = [(self.weight * bound, 0, board.zobrist)]
+
+        while frontier:
+            _, g, key = heapq.heappop(frontier)
+            g = -g
+            state = table[key]
+            if key in closed or state[0] < g:
+                continue
+            closed.add(key)
+
+            player, boxes = state[3], state[4]
+            if boxes != bits or player != board.player:
+                board.shift_state(player, _squares(bits & ~boxes), _squares(boxes & ~bits))
+                bits = boxes
+            if board.end_test():
+                return self._path(table, key)
+            self._expand()
+
+            for (box, direction_id), bound in self._children(board):
+                child = board.zobrist
+                if child in closed:
+                    continue
+                known = table.get(child)
+                if known is None or g + 1 < known[0]:
+                    boxes = bits ^ (1 << box) ^ (1 << neighbours[box][direction_id])
+                    table[child] = (g + 1, key, (box, direction_id), board.player, boxes)
+                    heapq.heappush(frontier, (g + 1 + self.weight * bound, -(g + 1), child))
+
+        return None
+
+    @staticmethod
+    def _path(table, key):
+        solution = []
+        while table[key][1] is not None:
+            _, key, push = table[key][:3]
+            solution.append(push)
+        return solution[::-1]
+
+    def _idastar(self, board):
+        """
+        Iterative deepening A*: depth first searches bounded by f, the
+        bound growing to the smallest f that exceeded it. Within an
+        iteration the transposition table prunes states already reached
+        with a smaller or equal g.
+        """
+        threshold = self.engine.lower_bound(board)
+        if threshold is None:
+            return None
+        threshold *= self.weight
+
+        while True:
+            self.table = {}
+            solution = []
+            exceeded = self._dfs(board, 0, threshold, solution)
+            if exceeded is None:
+                return solution[::-1]
+            if exceeded == float('inf'):
+                return None
+            threshold = exceeded
+
+    def _dfs(self, board, g, threshold, solution):
+        """
+        Returns None once a solution is found, its pushes appended to solution
+        in reverse order, or else the smallest f beyond the threshold.
+        """
+        if board.end_test():
+            return None
+        if self.table.get(board.zobrist, g + 1) <= g:
+            return float('inf')
+        self.table[board.zobrist] = g
+        self._expand()
+
+        # children are searched best lower bound first
+        children = sorted(self._children(board), key=lambda child: child[1])
+        smallest = float('inf')
+        for push, bound in children:
+            f = g + 1 + self.weight * bound
+            if f > threshold:
+                smallest = min(smallest, f)
+                continue
+            board.push_box(*push)
+            exceeded = self._dfs(board, g + 1, threshold, solution)
+            board.pop_move()
+            if exceeded is None:
+                solution.append(push)
+                return None
+            smallest = min(smallest, exceeded)
+
+        return smallest
+
+
+def expert_examples(game, solution):
+    """
+    Replays a push solution in the action space of a game and returns a
+    compact training Example per action: the board, the expert action as a
+    one-hot policy and the value 1 of a solved puzzle.
+    """
+    board = game.get_initial_board()
+    examples = []
+
+    for box, direction_id in solution:
+        actions = game.push_actions(board, box, direction_id)
+        if actions is None:
+            raise ValueError("Solution push {} is not reachable".format((box, direction_id)))
+        for action in actions:
+            pi = np.zeros(game.get_action_size(), dtype=np.float32)
+            pi[action] = 1
+            examples.append(compress_example(board.board, pi, 1))
+            board = game.get_next_state(board, action)
+
+    if game.has_puzzle_ended(board) != 1:
+        raise ValueError("Solution does not solve the puzzle")
+    return examples
+
+
+def puzzle_paths(folder=os.path.join('..', 'data')):
+    """
+    Paths of the puzzleN.txt files of a folder, in puzzle order.
+    """
+    paths = glob.glob(os.path.join(folder, 'puzzle*.txt'))
+    return sorted(paths, key=lambda path: int(re.findall(r'\d+', os.path.basename(path))[0]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Solve Sokoban puzzles with A* or IDA* on pushes")
+    parser.add_argument('puzzles', nargs='*', help="Puzzle files, every data/puzzleN.txt by default")
+    parser.add_argument('-a', '--algorithm', default='astar', choices=PushSolver.ALGORITHMS)
+    parser.add_argument('-n', '--max_nodes', dest='maxNodes', type=int, default=1000000,
+                        help="Expanded states before a puzzle is given up, 0 for no limit")
+    parser.add_argument('-t', '--max_seconds', dest='maxSeconds', type=float, default=60,
+                        help="Seconds before a puzzle is given up, 0 for no limit")
+    parser.add_argument('-w', '--weight', type=float, default=1.,
+                        help="Weight of the lower bound, above 1 for faster solutions at most weight times longer")
+    args = parser.parse_args()
+
+    print('{:<16} {:<11} {:>7} {:>10} {:>9} {:>11}'.format('puzzle', 'status', 'pushes', 'nodes', 'seconds', 'nodes/s'))
+    for path in args.puzzles or puzzle_paths():
+        with open(path) as f:
+            solver = PushSolver(f.read(), args.maxNodes, args.maxSeconds, args.weight)
+        report = solver.solve(args.algorithm)
+        pushes = len(report.solution) if report.solution is not None else '-'
+        print('{:<16} {:<11} {:>7} {:>10} {:>9.2f} {:>11.0f}'.format(
+            os.path.basename(path), report.status, pushes, report.nodes, report.seconds,
+            report.nodes / max(report.seconds, 1e-9)))
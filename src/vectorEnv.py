@@ -0,0 +1,211 @@
+import numpy as np
+from sokobanLogic import Board
+from sokobanGame import SokobanDirectional, SokobanPush
+
+
+class VectorSokoban():
+    """
+    N boards of the same level stepped in lock-step. The state of every board
+    is one row of boards, a (N, width, height) uint8 array of character codes
+    laid out like Board.board, so that it is also the network input. The
+    player squares are kept alongside as flat indices (x * height + y).
+
+    Actions follow the encoding of the game: SokobanDirectional directions or
+    the target squares of Sokoban, each followed by the pass action. The push
+    level SokobanPush is not supported, its actions need the player walks.
+    """
+
+    _box = np.zeros(len(Board._characters), dtype=bool)
+    _box[[Board._characters['$'], Board._characters['*']]] = True
+
+    def __init__(self, game, num_boards):
+        if isinstance(game, SokobanPush):
+            raise ValueError("VectorSokoban only runs move level games")
+        self.game = game
+        self.directional = isinstance(game, SokobanDirectional)
+        self.action_size = game.get_action_size()
+
+        board = game.get_initial_board()
+        self.level = board.level
+        self.width, self.height = board.width, board.height
+        self.initial = board.board
+
+        self.boards = np.empty((num_boards, self.width, self.height), dtype=np.uint8)
+        self.player = np.empty(num_boards, dtype=np.int64)
+        self.reset()
+
+    def __len__(self):
+        return len(self.player)
+
+    @property
+    def cells(self):
+        """
+        (N, size) view of boards indexed by flat square index.
+        """
+        return self.boards.reshape(len(self), -1)
+
+    @classmethod
+    def from_boards(cls, game, boards):
+        """
+        Returns an environment holding the states of a list of Boards.
+        """
+        env = cls(game, len(boards))
+        env.boards[:] = np.stack([board.board for board in boards])
+        env.player[:] = [board.player for board in boards]
+        return env
+
+    def to_board(self, i):
+        """
+        Returns the ith state as a Board, e.g. to search it with MCTS.
+        """
+        board = self.game.get_initial_board()
+        board.set_state(self.player[i], self._box[self.cells[i]])
+        return board
+
+    def reset(self, ids=None):
+        """
+        Puts the boards ids, all of them by default, back to the initial state.
+        """
+        ids = slice(None) if ids is None else ids
+        self.boards[ids] = self.initial
+        self.player[ids] = self.level.initial_player
+
+    def encode(self):
+        """
+        Returns the (N, width, height) float32 network input of the boards.
+        """
+        return self.boards.astype(np.float32)
+
+    def get_legal_directions(self):
+        """
+        Returns a (N, 4) bool array of the legal directions of every board:
+        the target square is free, or holds a box that can be pushed onto a
+        free square that is not dead.
+        """
+        level = self.level
+        cells = self.cells
+        rows = np.arange(len(self))[:, None]
+
+        targets = level.neighbour_table[self.player]
+        open_ = targets >= 0
+        targets = np.where(open_, targets, 0)
+        pushes = open_ & self._box[cells[rows, targets]]
+
+        beyond = level.neighbour_table[targets, np.arange(4)]
+        free = beyond >= 0
+        beyond = np.where(free, beyond, 0)
+        push_ok = free & ~self._box[cells[rows, beyond]] & ~level.dead[beyond]
+
+        return open_ & (~pushes | push_ok)
+
+    def get_valid_moves(self):
+        """
+        Returns the (N, action_size) valid moves of every board, the pass
+        action being the only valid one of a board without legal moves.
+        """
+        legal = self.get_legal_directions()
+        valid_moves = np.zeros((len(self), self.action_size), dtype=int)
+
+        if self.directional:
+            valid_moves[:, :4] = legal
+        else:
+            rows, directions = np.nonzero(legal)
+            valid_moves[rows, self.level.neighbour_table[self.player[rows], directions]] = 1
+        valid_moves[:, -1] = ~legal.any(axis=1)
+
+        return valid_moves
+
+    def get_next_state(self, actions):
+        """
+        Applies one legal action to every board in place and returns the environment.
+        """
+        level = self.level
+        cells = self.cells
+        directions = self._action_directions(np.asarray(actions))
+
+        rows = np.flatnonzero(directions >= 0)
+        directions = directions[rows]
+        player = self.player[rows]
+        targets = level.neighbour_table[player, directions]
+
+        pushed = self._box[cells[rows, targets]]
+        beyond = level.neighbour_table[targets[pushed], directions[pushed]]
+        cells[rows[pushed], beyond] = level.box_codes[beyond]
+
+        cells[rows, player] = level.base[player]
+        cells[rows, targets] = level.player_codes[targets]
+        self.player[rows] = targets
+
+        return self
+
+    def _action_directions(self, actions):
+        """
+        Returns the direction id of every action, -1 for a pass.
+        """
+        if self.directional:
+            return np.where(actions < 4, actions, -1)
+
+        matches = self.level.neighbour_table[self.player] == actions[:, None]
+        return np.where(matches.any(axis=1), np.argmax(matches, axis=1), -1)
+
+    def has_puzzle_ended(self):
+        """
+        Returns, for every board, 1 if it is solved, -1 if it is deadlocked
+        and 0 otherwise, with the deadlock tests of Board.is_deadlocked.
+        """
+        level = self.level
+        cells = self.cells
+        boxes = self._box[cells]
+        loose = boxes & ~level.goals
+
+        solved = ~loose.any(axis=1)
+        deadlocked = (loose & level.dead).any(axis=1)
+
+        undecided = np.flatnonzero(~solved & ~deadlocked)
+        if len(undecided):
+            stuck = self._blocked_or_frozen(boxes[undecided])
+            deadlocked[undecided] = (loose[undecided] & stuck).any(axis=1)
+
+        return np.where(solved, 1, np.where(deadlocked, -1, 0))
+
+    def _blocked_or_frozen(self, boxes):
+        """
+        Marks the boxes of a (n, size) array that are part of a 2x2 block of
+        walls and boxes, or frozen. The frozen boxes are the greatest set of
+        boxes blocked along both axes when frozen boxes count as walls, found
+        by dropping unblocked boxes until the set is stable.
+        """
+        n = len(boxes)
+        shape = (n, self.width + 2, self.height + 2)
+        walls = np.ones(shape, dtype=bool)
+        walls[:, 1:-1, 1:-1] = self.level.walls.reshape(self.width, self.height)
+        dead = np.zeros(shape, dtype=bool)
+        dead[:, 1:-1, 1:-1] = self.level.dead.reshape(self.width, self.height)
+        frozen = np.zeros(shape, dtype=bool)
+        frozen[:, 1:-1, 1:-1] = boxes.reshape(n, self.width, self.height)
+        occupied = walls | frozen
+
+        def at(array, dx, dy):
+            return array[:, 1 + dx:self.width + 1 + dx, 1 + dy:self.height + 1 + dy]
+
+        directions = Board._directions
+        blocked = np.zeros((n, self.width, self.height), dtype=bool)
+        for first, second in ((0, 1), (1, 2), (2, 3), (3, 0)):
+            (ax, ay), (bx, by) = directions[first], directions[second]
+            corner = at(walls, ax, ay) & at(walls, bx, by)
+            blocked |= at(occupied, ax, ay) & at(occupied, bx, by) & \
+                (at(occupied, ax + bx, ay + by) | corner)
+
+        def axis_blocked(dx, dy):
+            return at(walls, dx, dy) | at(walls, -dx, -dy) | \
+                (at(dead, dx, dy) & at(dead, -dx, -dy)) | \
+                at(frozen, dx, dy) | at(frozen, -dx, -dy)
+
+        while True:
+            inner = at(frozen, 0, 0)
+            stable = inner & axis_blocked(1, 0) & axis_blocked(0, 1)
+            if np.array_equal(stable, inner):
+                break
+            frozen[:, 1:-1, 1:-1] = stable
+
+        return (blocked | stable).reshape(n, -1)